@@ -0,0 +1,112 @@
+import asyncio
+from itertools import islice
+from CuckooHash_SG import CuckooHash
+
+# A CuckooHash for asyncio programs, which never blocks the event loop for
+# longer than it takes to handle chunkSize entries.
+#
+# The table resizes incrementally (see the resizeStep option of CuckooHash),
+# so an insert that makes it grow only allocates the new arrays, and the
+# entries are moved to them by a background task, chunkSize entries at a
+# time, yielding to the event loop between chunks. Meanwhile every operation
+# keeps working, looking for keys in both the new arrays and the old ones,
+# and moving a few entries itself. insertMany and rebuild yield to the event
+# loop in the same way.
+#
+# Only use the table from the thread running its event loop.
+class AsyncCuckooHash(object):
+
+    # Create an empty table of the given size. Any other options are passed
+    # on to CuckooHash, except that the table always resizes incrementally,
+    # by default moving 16 entries per operation. The buckets have 4 slots
+    # by default, since an entry that can't be placed while the table 
+    # resizes makes it rehash everything at once, which is very unlikely 
+    # with buckets of 4 slots but not with buckets of 1.
+    def __init__(self, size, chunkSize = 1000, **options):
+        assert chunkSize > 0 and not options.get("threadSafe")
+        if options.get("resizeStep") is None: options["resizeStep"] = 16
+        options.setdefault("bucketSize", 4)
+        self.__table = CuckooHash(size, **options)
+        self.__chunkSize = chunkSize
+        self.__task = None
+
+    # Return how many keys are in the table
+    def __len__(self): return len(self.__table)
+
+    # Return the CuckooHash holding the entries
+    def table(self): return self.__table
+
+    # Return True if the entries are being moved to new arrays
+    def isResizing(self): return self.__table.isResizing()
+
+    # Given a key, return the data associated with it, or None if the key is
+    # not in the table.
+    def find(self, k): return self.__table.find(k)
+
+    # Given an iterable of keys, return a list with the data associated with
+    # each key, or None for the keys that are not in the table.
+    def findMany(self, keys): return self.__table.findMany(keys)
+
+    # Given a key, delete its entry and return the key data pair as a tuple,
+    # or return None if the key is not in the table. (With minLoadFactor, a 
+    # delete may start shrinking the table, just like an insert may start 
+    # growing it.)
+    async def delete(self, k): 
+        n = self.__table.delete(k)
+        self.__startResizing()
+        return n
+
+    # Insert a new entry with the given key and data. Return True, or False
+    # if the key was already in the table.
+    async def insert(self, k, d):
+        inserted = self.__table.insert(k, d)
+        self.__startResizing()
+        return inserted
+
+    # Insert the (key, data) pairs of an iterable chunkSize at a time,
+    # yielding to the event loop between chunks. Return how many new keys
+    # were inserted. (The pairs are inserted one by one, rather than with 
+    # CuckooHash.insertMany, which resizes all at once to fit them.)
+    async def insertMany(self, pairs):
+        if hasattr(pairs, "items"): pairs = pairs.items()
+        pairs = iter(pairs)
+        insert = self.__table.insert
+        n = 0
+        while True:
+            chunk = list(islice(pairs, self.__chunkSize))
+            if not chunk: break
+            for k, d in chunk: n += insert(k, d)
+            self.__startResizing()
+            await asyncio.sleep(0)
+        return n
+
+    # Move every entry to new arrays of size slots each (by default, the
+    # current size) with new hash functions, and return once they are all
+    # moved. Lookups are still served while the entries move. A resize in
+    # progress is waited for first, since CuckooHash.rehash would otherwise
+    # finish it all at once.
+    async def rebuild(self, size = None):
+        self.__startResizing()
+        await self.resized()
+        self.__table.rehash(size)
+        self.__startResizing()
+        await self.resized()
+
+    # Return once the table is not resizing anymore
+    async def resized(self):
+        while self.__task is not None: await asyncio.shield(self.__task)
+
+    # If the table started resizing, start the background task that moves
+    # its entries, unless it is already running.
+    def __startResizing(self):
+        if self.__task is None and self.__table.isResizing():
+            self.__task = asyncio.get_running_loop().create_task(
+                self.__moveEntries())
+
+    # Move the entries of the resize in progress chunkSize at a time,
+    # yielding to the event loop between chunks, until the resize is over.
+    async def __moveEntries(self):
+        try:
+            while self.__table.continueResize(self.__chunkSize):
+                await asyncio.sleep(0)
+        finally: self.__task = None
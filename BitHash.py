@@ -1,6 +1,21 @@
 import cityhash 
+import copy
+import hashlib
 import random
 
+# NumPy is optional. It is only needed to hash whole arrays of keys at once 
+# with the hashArray methods of the hash families below.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# xxhash is optional too. It is only needed by XXHashFamily.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 __rnd = random.Random()   # get a random number generator for this module
 __rnd.seed("BitHash random numbers") # set the RNG seed to a known value
 __BitHashSeeds = None
@@ -23,6 +38,264 @@ ResetBitHash() # set up the seeds in advance of the first BitHash call
 # causes a different seed to be used for each possible hashFuncNum.
 def BitHash(s, hashFuncNum = 1):
     return cityhash.CityHash64WithSeed(str(s), __BitHashSeeds[hashFuncNum-1])
+
+# returns a new random number generator seeded from this module's RNG, so that
+# every BitHashFamily gets its own reproducible stream of seeds.
+def _newRandom():
+    return random.Random(__rnd.getrandbits(64))
+
+_MASK64 = (1 << 64) - 1
+
+# The range of ints that IntHashFamily takes as keys: those that fit in 64
+# bits, signed or unsigned
+_MIN_INT, _MAX_INT = -(1 << 63), 1 << 64
+
+# returns key s in a form that the hash families can hash: str and bytes 
+# keys as they are (a bytes key is not turned into the str of its repr), and
+# any other key converted to its str. (For ints, str is faster than 
+# to_bytes, and IntHashFamily avoids both.)
+def _keyBytes(s):
+    t = type(s)
+    if t is str or t is bytes: return s
+    return str(s)
+
+# The seed that the hash families mix into their base seed for keys of each
+# type, so that keys of different types whose str (or bytes) are the same, 
+# e.g. 1, "1" and b"1", have unrelated base hashes. It is a CityHash of the
+# name of the type, so that it is the same in every process. str keys use 
+# the base seed itself.
+_TYPE_SEEDS = {str: 0}
+
+# returns the seed to mix into the base seed for key s (see _TYPE_SEEDS)
+def _typeSeed(s):
+    t = type(s)
+    seed = _TYPE_SEEDS.get(t)
+    if seed is None:
+        name = "%s.%s" % (t.__module__, t.__qualname__)
+        seed = _TYPE_SEEDS[t] = cityhash.CityHash64(name)
+    return seed
+
+# returns x scrambled by the splitmix64 finalizer, a fast bijective mix of 
+# all 64 bits of x into all 64 bits of the result.
+def _mix64(x):
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+# returns every element of the numpy uint64 array x scrambled by _mix64. 
+# NumPy's uint64 arithmetic wraps around, so no masking is needed.
+def _mix64Array(x):
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+    return x ^ (x >> numpy.uint64(31))
+
+# A family of independent hash functions that carries its own seeds, instead of
+# sharing the module-global seeds used by BitHash. Resetting one family gives
+# it a new set of hash functions without changing the hash values computed by
+# BitHash or by any other BitHashFamily, so each CuckooHash can own one and 
+# rehash itself without disturbing any other live table.
+#
+# Hashing is split in two steps. A key's 64-bit base hash is computed once 
+# with CityHash (using a seed of its own that reset never changes, mixed with
+# a seed for the type of the key) of the key itself for str and bytes keys, 
+# or of its str for any other key, and each hash function derives a 32-bit 
+# hash value from the base hash by multiplying it with the function's (odd)
+# seed and keeping the top 32 bits of the low 64 bits of the product, i.e. 
+# multiply-shift hashing. Callers that keep the base hash of a key can 
+# therefore compute its hash values again, even after a reset, with one 
+# multiplication and no str conversion or CityHash call.
+#
+# The subclasses below only compute the base hash differently, so any of them
+# can be used wherever a BitHashFamily is (see HASH_BACKENDS).
+class BitHashFamily(object):
+    
+    # Create a family of numFuncs hash functions, each with its own seed.
+    def __init__(self, numFuncs = 2):
+        assert 0 < numFuncs <= 1000
+        self.__rnd = _newRandom()
+        self.__baseSeed = self.__rnd.getrandbits(64)
+        self.__seeds = [0] * numFuncs
+        self.reset()
+        
+    # Return how many hash functions are in the family
+    def __len__(self): return len(self.__seeds)
+    
+    # Draw new seeds for every hash function in the family, so that subsequent
+    # calls to hash are effectively based on a new set of hash functions. 
+    # Base hashes do not change.
+    def reset(self):
+        for i in range(len(self.__seeds)):
+            self.__seeds[i] = self.__rnd.getrandbits(64) | 1
+            
+    # returns a new family of as many hash functions, with newly drawn seeds 
+    # but the same base hash, so that base hashes computed by this family 
+    # can be used with the new one, while this family remains unchanged.
+    def spawn(self):
+        other = copy.copy(self)
+        other.__seeds = list(self.__seeds)
+        other.reset()
+        return other
+    
+    # returns the seeds of the family, as a list with the base seed followed 
+    # by the seed of each hash function, e.g. to save them along with a table
+    # hashed by this family.
+    def getSeeds(self): return [self.__baseSeed] + self.__seeds
+    
+    # returns the seed of the base hash
+    def baseSeed(self): return self.__baseSeed
+    
+    # Set the seeds of the family to seeds returned by getSeeds, so that it 
+    # hashes exactly like the family they came from (if it is of the same 
+    # class).
+    def setSeeds(self, seeds):
+        assert len(seeds) == len(self.__seeds) + 1
+        self.__baseSeed = seeds[0]
+        self.__seeds = list(seeds[1:])
+    
+    # returns the 64-bit base hash of s, which does not depend on the seeds
+    # of the hash functions.
+    def baseHash(self, s):
+        return cityhash.CityHash64WithSeed(_keyBytes(s), 
+                                           self.__baseSeed ^ _typeSeed(s))
+    
+    # returns a numpy uint64 array with the baseHash of every key in keys
+    def baseHashArray(self, keys):
+        return numpy.array([self.baseHash(k) for k in keys], dtype=numpy.uint64)
+    
+    # returns the 32-bit hash value of the family's hashFuncNum'th hash 
+    # function (numbered from 1, just like BitHash) for a key whose base hash
+    # is b.
+    def hashFromBase(self, b, hashFuncNum = 1):
+        return ((b * self.__seeds[hashFuncNum-1]) & _MASK64) >> 32
+    
+    # returns a numpy uint64 array with the hashFromBase of every base hash
+    # in the numpy uint64 array b.
+    def hashFromBaseArray(self, b, hashFuncNum = 1):
+        seed = numpy.uint64(self.__seeds[hashFuncNum-1])
+        return (b * seed) >> numpy.uint64(32)
+            
+    # returns a 32-bit hash value for s using the family's hashFuncNum'th 
+    # hash function (numbered from 1, just like BitHash).
+    def hash(self, s, hashFuncNum = 1):
+        return self.hashFromBase(self.baseHash(s), hashFuncNum)
+    
+    # returns a numpy uint64 array with the hash value for every key in keys,
+    # using the family's hashFuncNum'th hash function. Requires NumPy.
+    def hashArray(self, keys, hashFuncNum = 1):
+        if numpy is None: raise ImportError("hashArray requires numpy")
+        return self.hashFromBaseArray(self.baseHashArray(keys), hashFuncNum)
+
+# A family of independent hash functions for int keys, which works just like
+# BitHashFamily except that the base hash of a key is simply its 64 bits, 
+# instead of a CityHash of its str, which is much cheaper. The hash functions
+# are then plain multiply-shift hash functions of the key, which form a 
+# universal family. baseHashArray computes the base hashes of a whole array of
+# keys at once with NumPy.
+# Keys must fit in 64 bits (signed or unsigned), i.e. be in the range 
+# [-2**63, 2**64), or else ValueError is raised, since two ints that only 
+# differ in their higher bits would otherwise always collide.
+class IntHashFamily(BitHashFamily):
+            
+    # returns the 64 bits of key k that the hash functions mix with their seed
+    def baseHash(self, k): 
+        if not _MIN_INT <= k < _MAX_INT: 
+            raise ValueError("int keys must fit in 64 bits")
+        return k & _MASK64
+    
+    # returns a numpy uint64 array with the baseHash of every key in keys
+    def baseHashArray(self, keys):
+        arr = numpy.asarray(keys)
+        if arr.dtype.kind == 'u': return arr.astype(numpy.uint64)
+        if arr.dtype.kind in 'ib': 
+            return arr.astype(numpy.int64).view(numpy.uint64)
+        
+        # The keys did not all fit in one NumPy integer type, e.g. a mix of
+        # negative ints and ints of 2**63 or more (or ints too big for any)
+        return numpy.array([self.baseHash(k) for k in keys], 
+                           dtype=numpy.uint64)
+    
+# A family of independent hash functions for bytes keys that are all exactly
+# keyWidth bytes long, which works just like IntHashFamily. The base hash of a
+# key is computed by splitting it into 8-byte little-endian words (padding the
+# last one with zeros) and mixing them together one at a time with _mix64.
+class BytesHashFamily(BitHashFamily):
+    
+    # Create a family of numFuncs hash functions for keys of keyWidth bytes.
+    def __init__(self, numFuncs = 2, keyWidth = 8):
+        assert keyWidth > 0
+        self.__keyWidth = keyWidth
+        super().__init__(numFuncs)
+        
+    # returns the base hash of the key k by mixing together its words
+    def baseHash(self, k):
+        if len(k) != self.__keyWidth:
+            raise ValueError("key must be %d bytes long" % self.__keyWidth)
+        h = 0
+        for i in range(0, self.__keyWidth, 8):
+            h = _mix64(h ^ int.from_bytes(k[i:i+8], "little"))
+        return h
+    
+    # returns a numpy uint64 array with the baseHash of every key in keys
+    def baseHashArray(self, keys):
+        # Join all the keys into one buffer, viewed as one row of bytes per 
+        # key, and copy the rows into rows padded to a whole number of words.
+        w = self.__keyWidth
+        keys = list(keys)
+        buf = b"".join(keys)
+        if len(buf) != len(keys) * w:
+            raise ValueError("keys must all be %d bytes long" % w)
+        rows = numpy.zeros((len(keys), -(-w // 8) * 8), dtype=numpy.uint8)
+        rows[:, :w] = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(-1, w)
+        words = rows.view("<u8")
+        
+        # Mix in the words one column at a time, just like baseHash
+        h = numpy.zeros(len(keys), dtype=numpy.uint64)
+        for i in range(words.shape[1]):
+            h = _mix64Array(h ^ words[:, i])
+        return h
+   
+# A family of independent hash functions that works just like BitHashFamily,
+# except that the base hash of a key is computed with xxHash (XXH64) instead 
+# of CityHash. Requires the xxhash package.
+class XXHashFamily(BitHashFamily):
+    
+    # Create a family of numFuncs hash functions, each with its own seed.
+    def __init__(self, numFuncs = 2):
+        if xxhash is None: raise ImportError("XXHashFamily requires xxhash")
+        super().__init__(numFuncs)
+    
+    # returns the 64-bit base hash of s
+    def baseHash(self, s):
+        return xxhash.xxh64_intdigest(_keyBytes(s), 
+                                      self.baseSeed() ^ _typeSeed(s))
+
+# A family of independent hash functions that works just like BitHashFamily,
+# except that the base hash of a key is its BLAKE2b hash (from hashlib, so 
+# nothing needs to be installed), keyed with the base seed. BLAKE2b is a 
+# cryptographic hash, so it is much slower than the others, but it can be 
+# used for keys chosen by an adversary, who can't find keys that collide 
+# without knowing the seed.
+class Blake2bHashFamily(BitHashFamily):
+    
+    # returns the 64-bit base hash of s
+    def baseHash(self, s):
+        key = (self.baseSeed() ^ _typeSeed(s)).to_bytes(8, "little")
+        s = _keyBytes(s)
+        if type(s) is str: s = s.encode()
+        h = hashlib.blake2b(s, digest_size = 8, key = key)
+        return int.from_bytes(h.digest(), "little")
+
+# The hash families that a CuckooHash can be asked to use by name (with its
+# hashBackend option), each of which computes base hashes differently:
+#   "city": CityHash (BitHashFamily), a fast hash of any key
+#   "xxhash": xxHash (XXHashFamily), a fast hash of any key (requires xxhash)
+#   "blake2b": BLAKE2b (Blake2bHashFamily), a slow but keyed cryptographic
+#       hash of any key
+#   "multiplyShift": the key itself (IntHashFamily), the fastest, for int 
+#       keys only
+HASH_BACKENDS = {"city": BitHashFamily, "xxhash": XXHashFamily, 
+                 "blake2b": Blake2bHashFamily, 
+                 "multiplyShift": IntHashFamily}
    
 def __main():
     # use BitHash to get two hash values for each of a bunch of strings
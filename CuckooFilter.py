@@ -0,0 +1,190 @@
+import math
+import random
+from BitHash import BitHashFamily, IntHashFamily, BytesHashFamily, _mix64
+
+# A cuckoo filter: a set of keys that only remembers a small fingerprint of
+# each key, so it takes a few bytes per key however big the keys are, but may
+# answer that a key is there when it isn't (a false positive), at a rate of
+# about fpRate. It never answers that a key isn't there when it is.
+#
+# It works like CuckooHash with buckets: each fingerprint has two candidate
+# buckets, and is stored in an empty slot of either one, or else evicts a
+# fingerprint from one of them, which moves to its other bucket, and so on.
+# Since only the fingerprint is kept, the other bucket of a fingerprint must
+# be computable from the fingerprint and the bucket it is in: the buckets of
+# a key are i1, from the key's hash, and i2 = i1 XOR hash(fingerprint), so
+# that either one is the other XOR hash(fingerprint). (This is why both
+# buckets are in the same array, whose number of buckets is a power of 2.)
+#
+# The fingerprints are bit-packed: each bucket is bucketSize fingerprints of
+# fpBits bits in a row, taking a whole number of bytes of a bytearray, and a
+# fingerprint of 0 marks an empty slot. A filter doesn't know its keys, so it
+# can't grow: an insert fails once the filter is full.
+#
+# delete should only be given keys that were inserted (and not deleted since)
+# because deleting any other key may delete the fingerprint of another key
+# that happens to share a bucket and fingerprint with it.
+class CuckooFilter(object):
+
+    # Create an empty filter for up to about capacity keys, whose false
+    # positive rate is about fpRate when it is full. keyType and keyWidth
+    # pick the hash functions just like for CuckooHash.
+    def __init__(self, capacity, fpRate = 0.01, bucketSize = 4,
+                 keyType = None, keyWidth = 8):
+        assert capacity > 0 and 0 < fpRate < 1 and bucketSize > 0
+
+        # A key is compared with the 2*bucketSize fingerprints of its two
+        # buckets, each of which matches with a chance of 1/2**fpBits.
+        self.__fpBits = max(1, math.ceil(math.log2(2 * bucketSize / fpRate)))
+        self.__bucketSize = bucketSize
+        self.__bucketBytes = -(-bucketSize * self.__fpBits // 8)  # ceil
+        self.__numBuckets = 1
+        while self.__numBuckets * bucketSize * 0.95 < capacity:
+            self.__numBuckets *= 2
+        self.__buckets = bytearray(self.__numBuckets * self.__bucketBytes)
+        self.__numKeys = 0
+        self.__maxLoop = 500
+
+        # A fingerprint evicted by an insert that ran out of evictions is
+        # kept here, as (bucket, fingerprint), rather than being lost.
+        self.__victim = None
+
+        if keyType is None:    self.__hashFamily = BitHashFamily(2)
+        elif keyType is int:   self.__hashFamily = IntHashFamily(2)
+        elif keyType is bytes: self.__hashFamily = BytesHashFamily(2, keyWidth)
+        else: raise ValueError("keyType must be None, int or bytes")
+        self.__mixBase = keyType is int
+
+    # Return how many keys have been inserted into the filter
+    def __len__(self): return self.__numKeys
+
+    # Return the total number of slots in the filter
+    def capacity(self): return self.__numBuckets * self.__bucketSize
+
+    # Return the fraction of slots currently in use
+    def loadFactor(self): return self.__numKeys / self.capacity()
+
+    # Return the number of bits of each fingerprint
+    def fingerprintBits(self): return self.__fpBits
+
+    # Return the chance that a key that isn't in the filter is reported to
+    # be in it, given how full the filter currently is.
+    def falsePositiveRate(self):
+        return 1 - (1 - 2**-self.__fpBits) ** \
+                   (2 * self.__bucketSize * self.loadFactor())
+
+    # Return how many bytes the fingerprints take
+    def sizeInBytes(self): return len(self.__buckets)
+
+    # Given a key, return its fingerprint (from 1 to 2**fpBits - 1) and its
+    # first bucket.
+    def __locate(self, k):
+        family = self.__hashFamily
+        b = family.baseHash(k)
+        
+        # The base hash of an int key is the key itself, and runs of 
+        # consecutive keys would get too many equal pairs of fingerprint and
+        # bucket from it, so it is mixed first.
+        if self.__mixBase: b = _mix64(b)
+        f = family.hashFromBase(b, 1) % ((1 << self.__fpBits) - 1) + 1
+        return f, family.hashFromBase(b, 2) % self.__numBuckets
+
+    # Given a fingerprint and one of its buckets, return its other bucket.
+    # The bucket is XORed with a number from 1 to numBuckets-1, so that the
+    # two buckets are never the same one (unless there is only one bucket).
+    def __otherBucket(self, i, f):
+        if self.__numBuckets == 1: return i
+        h = self.__hashFamily.hashFromBase(f, 2)
+        return i ^ (h % (self.__numBuckets-1) + 1)
+
+    # Return the list of fingerprints in bucket i
+    def __read(self, i):
+        size = self.__bucketBytes
+        bits = int.from_bytes(self.__buckets[i*size:(i+1)*size], "little")
+        mask = (1 << self.__fpBits) - 1
+        return [(bits >> (j * self.__fpBits)) & mask
+                for j in range(self.__bucketSize)]
+
+    # Store the given list of fingerprints in bucket i
+    def __write(self, i, bucket):
+        bits = 0
+        for j, f in enumerate(bucket): bits |= f << (j * self.__fpBits)
+        size = self.__bucketBytes
+        self.__buckets[i*size:(i+1)*size] = bits.to_bytes(size, "little")
+
+    # Put fingerprint f in an empty slot of bucket i and return True, or
+    # return False if bucket i is full.
+    def __add(self, i, f):
+        bucket = self.__read(i)
+        if 0 not in bucket: return False
+        bucket[bucket.index(0)] = f
+        self.__write(i, bucket)
+        return True
+
+    # Insert the key's fingerprint. Return True, or False if the filter is
+    # full. (Inserting a key twice stores its fingerprint twice, so that it
+    # can be deleted twice.)
+    def insert(self, k):
+        if self.__victim is not None: return False
+        f, i = self.__locate(k)
+        self.__place(i, f)
+        self.__numKeys += 1
+        return True
+    
+    # Place fingerprint f in bucket i or its other bucket. If both are full,
+    # evict a random fingerprint of one of them, and move it to its other 
+    # bucket, and so on. If we ran into an infinite eviction loop, keep the
+    # last evicted fingerprint as the victim, so that the filter is full but
+    # still knows every key.
+    def __place(self, i, f):
+        if self.__add(i, f) or self.__add(self.__otherBucket(i, f), f): 
+            return
+        
+        if random.randrange(2): i = self.__otherBucket(i, f)
+        for n in range(self.__maxLoop):
+            bucket = self.__read(i)
+            j = random.randrange(self.__bucketSize)
+            bucket[j], f = f, bucket[j]
+            self.__write(i, bucket)
+            i = self.__otherBucket(i, f)
+            if self.__add(i, f): return
+        self.__victim = (i, f)
+
+    # Return True if the key may be in the filter, or False if it definitely
+    # is not.
+    def contains(self, k):
+        f, i = self.__locate(k)
+        if f in self.__read(i): return True
+        i2 = self.__otherBucket(i, f)
+        if f in self.__read(i2): return True
+        return self.__victim is not None and self.__victim[1] == f and \
+               self.__victim[0] in (i, i2)
+
+    # Given an iterable of keys, return a list of bools telling whether each
+    # key may be in the filter.
+    def containsMany(self, keys): return [self.contains(k) for k in keys]
+
+    # Delete one copy of the key's fingerprint. Return True, or False if it
+    # was not found.
+    def delete(self, k):
+        f, i = self.__locate(k)
+        i2 = self.__otherBucket(i, f)
+        if self.__victim is not None and self.__victim[1] == f and \
+           self.__victim[0] in (i, i2):
+            self.__victim = None
+            self.__numKeys -= 1
+            return True
+
+        for i in (i, i2):
+            bucket = self.__read(i)
+            if f in bucket:
+                bucket[bucket.index(f)] = 0
+                self.__write(i, bucket)
+                self.__numKeys -= 1
+
+                # A slot was freed, so the victim may now have a place
+                if self.__victim is not None:
+                    victim, self.__victim = self.__victim, None
+                    self.__place(*victim)
+                return True
+        return False
@@ -1,180 +1,1463 @@
-from BitHash import BitHash, ResetBitHash
+import copy
+import pickle
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import MutableMapping, ValuesView, ItemsView
+from contextlib import contextmanager, nullcontext
+from array import array
+from BitHash import BitHashFamily, IntHashFamily, BytesHashFamily, \
+                    HASH_BACKENDS
+from MappedCuckooHash import writeSnapshot
+from FrozenCuckooHash import FrozenCuckooHash
+
+# NumPy is optional. With it, tables of int or bytes keys hash and look up
+# whole batches of keys with array operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # I hereby certify that this program is solely the result of my own work and 
 # is in compliance with the Academic Integrity policy of the course syllabus 
 # and the academic integrity policy of the CS department.
 # Signed Chaya (Sarale) Goldberger, 05/21/2023
 
-class Node(object):
-    def __init__(self, k, d):
-        self.key = k
-        self.data = d
+# Marks an empty slot in the key array. A unique object is used (rather than
+# None) so that any value, including None, can be stored as a key.
+_EMPTY = object()
 
-class CuckooHash(object):
-    
-    # Given an int called size, initialize a CuckooHash object with two empty 
-    # lists of size length, and an attribute of 0 keys so far.
-    # Ensure that the input parameter size if is greater than 0.
-    def __init__(self, size):
-        assert size > 0
-        self.__hashArr1 = [None] * size
-        self.__hashArr2 = [None] * size
-        self.__numKeys = 0
+# The number of stripes (groups of buckets sharing a lock and a version 
+# number) of a thread-safe CuckooHash. Bucket i belongs to stripe 
+# i % _NUM_STRIPES, whatever the size of the arrays.
+_NUM_STRIPES = 64
+
+# Stands in for the lock of a table that isn't thread-safe
+_NO_LOCK = nullcontext()
+
+# How many entries a cache evicts to make room for an entry displaced by an
+# insert that ran into an eviction loop, before it drops that entry instead.
+_CACHE_TRIES = 4
+
+# The number of times resizing the arrays (or, for a thread-safe table, 
+# growing them to make room for one insert) or freezing the table is 
+# attempted, with new hash functions and bigger arrays each time, before 
+# giving up with RuntimeError. Running out of attempts means that too many 
+# keys have the same base hash (e.g. unequal keys of the same type with the
+# same str) to ever fit in their buckets and the stash, however big the 
+# arrays are.
+_RESIZE_TRIES = 8
+
+# Return the default maximum load factor for the given bucket size and number
+# of hash arrays, i.e. how full the table may get before it grows. With one 
+# slot per bucket, two hash arrays can only be kept about half full; with more
+# slots per bucket or more hash arrays cuckoo hashing reliably reaches much 
+# higher loads (~90% for 2 slots or 3 arrays, ~97% for 4 slots or 4 arrays).
+def defaultMaxLoadFactor(bucketSize, numTables = 2):
+    if bucketSize == 1: return {2: 0.5, 3: 0.85}.get(numTables, 0.9)
+    if bucketSize < 4 and numTables == 2: return 0.85
+    return 0.95
+
+# Entries are not stored as individual Node objects. Instead, all hash arrays
+# are laid out back to back in three parallel flat arrays: one list of keys,
+# one list of data, and one array of unsigned 64-bit cached hash values.
+# Each hash array is split into buckets of bucketSize consecutive slots, so
+# array 1 occupies slots [0, numBuckets*bucketSize), array 2 the same number
+# of slots right after it, and so on.
+#
+# Memory: each slot costs 8 bytes for the key reference, 8 bytes for the data
+# reference and 8 bytes for the cached hash, i.e. 24 bytes per slot. With one
+# slot per bucket the table is kept at most half full, so that is 48 bytes per
+# entry right after a grow and up to ~72 bytes per entry just before one (not
+# counting the key and data objects themselves). With 4 slots per bucket the
+# table runs at up to 95% load, i.e. roughly 25-38 bytes per entry. Storing 
+# each entry as a Node object cost about 100 bytes for the Node and its 
+# __dict__ on CPython 3.11, on top of 8 bytes for each of the two list slots
+# pointing at Nodes or None.
+#
+# A CuckooHash is also a MutableMapping, so it can be used like a dict: 
+# c[k] = d inserts k or updates its data in place, c[k] and del c[k] raise 
+# KeyError for missing keys, and keys(), values() and items() are views that
+# go through the slots one at a time rather than building lists.
+class CuckooHash(MutableMapping):
+
+    # Given an int called size, initialize a CuckooHash object with numTables
+    # (by default two) empty hash arrays of size length, and an attribute of 0
+    # keys so far. Ensure that the input parameter size if is greater than 0.
+    # Each CuckooHash owns its own family of hash functions, one per hash 
+    # array, so that growing (and rehashing) this table never affects any 
+    # other table.
+    # Each hash array is divided into buckets of bucketSize slots, and the 
+    # table grows once more than maxLoadFactor of all slots are in use (by
+    # default, a load factor suited to the bucket size and number of arrays).
+    # If keyType is int (or bytes, for keys that are all keyWidth bytes long),
+    # keys are hashed without str and CityHash, and when NumPy is installed 
+    # findMany and containsMany hash and look up all their keys at once. 
+    # (Only bulk lookups are vectorized: insertMany places its pairs one at
+    # a time, which is where nearly all of its time goes.)
+    # If resizeStep is given, the table resizes incrementally: the old arrays
+    # are kept alongside the new ones, and every following operation moves 
+    # at most resizeStep entries from the old arrays to the new ones, so that
+    # no single operation has to rehash the whole table.
+    # If stashSize is given, up to stashSize entries that could not be placed
+    # because of an infinite eviction loop are kept in a small overflow stash
+    # instead of growing the table right away.
+    # insertStrategy chooses how a key whose candidate buckets are all full is
+    # placed: "random" evicts entries along a random walk, while "bfs" first
+    # searches breadth-first for the shortest chain of evictions that ends in
+    # an empty slot, and only then moves the entries along it.
+    # If collectStats is True, the table counts its evictions, failed 
+    # placements, grows and rehashes (see stats()). If onResize is given, it
+    # is called as onResize(oldCapacity, newCapacity) after every resize.
+    # If threadSafe is True, the table can be shared by many threads: find 
+    # takes no locks, and insert and delete only lock the buckets they change
+    # (see __findOptimistic). A thread-safe table always resizes all at once
+    # and has no stash.
+    # If missSummary is True, the table keeps a small counter for every 
+    # quarter slot, counting the keys whose hash value for array 1 maps to it,
+    # so that find (and the check insert makes before adding a key) can 
+    # reject most missing keys after computing one hash value and reading one
+    # counter, without looking in any bucket.
+    # If minLoadFactor is given, a delete that leaves less than 
+    # minLoadFactor of all slots in use shrinks the table (see compact). It 
+    # must be less than half of maxLoadFactor, so that a table that just 
+    # shrank or grew doesn't have to resize again right away.
+    # hashBackend, if given, picks how keys are hashed instead of keyType: 
+    # either the name of one of the built-in hash families of 
+    # BitHash.HASH_BACKENDS ("city", "xxhash", "blake2b" or "multiplyShift")
+    # or a hash family class like them, which is called with the number of
+    # hash functions it should have.
+    # If cache is True, the table is a cache that never grows: once it holds
+    # as many keys as maxLoadFactor allows, inserting a new key first evicts
+    # an entry chosen by the CLOCK policy (see __evict), and an entry left 
+    # without a slot by an eviction loop is dropped rather than making the 
+    # table grow. A cache counts its hits, misses and evicted entries (see
+    # stats()). It can't be thread-safe or resize incrementally.
+    # If changeLog is True, every change made to the table is appended to a
+    # log, which followers replay to keep their copies of the table up to 
+    # date (see changesSince). A cache can't keep a change log.
+    def __init__(self, size, bucketSize = 1, maxLoadFactor = None, 
+                 numTables = 2, keyType = None, keyWidth = 8, 
+                 resizeStep = None, stashSize = 0, insertStrategy = "random",
+                 collectStats = False, onResize = None, threadSafe = False,
+                 missSummary = False, minLoadFactor = None, 
+                 hashBackend = None, cache = False, changeLog = False):
+        assert size > 0 and bucketSize > 0 and numTables >= 2
+        assert resizeStep is None or resizeStep > 0
+        assert stashSize >= 0
+        assert not threadSafe or (resizeStep is None and stashSize == 0)
+        assert not cache or (resizeStep is None and not threadSafe and 
+                             minLoadFactor is None and not changeLog)
+        if maxLoadFactor is None: 
+            maxLoadFactor = defaultMaxLoadFactor(bucketSize, numTables)
+        assert 0 < maxLoadFactor <= 1
+        assert minLoadFactor is None or 0 < minLoadFactor < maxLoadFactor/2
+        
+        self.__numTables = numTables
+        self.__bucketSize = bucketSize
+        self.__maxLoadFactor = maxLoadFactor
+        self.__minLoadFactor = minLoadFactor or 0
+        
+        # Long eviction chains are needed to reach the higher load factors of
+        # bigger buckets or more arrays, and they are still short on average
+        # since each displaced key has more slots to choose from.
+        self.__maxLoop = 500 if bucketSize * numTables > 2 else 16
+        
+        if insertStrategy not in ("random", "bfs"):
+            raise ValueError('insertStrategy must be "random" or "bfs"')
+        self.__bfs = insertStrategy == "bfs"
+        
+        if keyType not in (None, int, bytes):
+            raise ValueError("keyType must be None, int or bytes")
+        if isinstance(hashBackend, str):
+            if hashBackend not in HASH_BACKENDS:
+                raise ValueError("hashBackend must be one of " + 
+                                 ", ".join(HASH_BACKENDS))
+            hashBackend = HASH_BACKENDS[hashBackend]
+        if hashBackend is not None: 
+            self.__hashFamily = hashBackend(numTables)
+        elif keyType is None:  self.__hashFamily = BitHashFamily(numTables)
+        elif keyType is int:   self.__hashFamily = IntHashFamily(numTables)
+        else: self.__hashFamily = BytesHashFamily(numTables, keyWidth)
+        self.__keyWidth = keyWidth
+        self.__vectorized = keyType is not None and numpy is not None
+        
+        # During an incremental resize, __old is a CuckooHash holding the old
+        # arrays (with their own hash functions), and __cursor is the next 
+        # slot of the old arrays to move.
+        self.__resizeStep = resizeStep
+        self.__old = None
+        self.__cursor = 0
+        
+        self.__stashSize = stashSize
+        self.__missSummary = missSummary
+        
+        # A cache keeps a reference bit per slot (in __allocate), which is
+        # set whenever the slot's entry is found, and the position of the 
+        # CLOCK hand, along with its counters.
+        self.__cache = cache
+        self.__hits = self.__misses = self.__cacheEvictions = 0
+        
+        # The change log is a list of changes, each a tuple of an operation
+        # and its arguments: ("insert", k, d), ("set", k, d), ("delete", k) 
+        # or ("clear",). Changes are numbered from 0 in the order they were 
+        # made, and __logStart is the number of the first change in the 
+        # list, since trimLog drops the oldest ones.
+        self.__log = [] if changeLog else None
+        self.__logStart = 0
+        
+        # The counters are only kept if asked for, and only updated off the
+        # common paths (when entries are evicted or the table resizes), so
+        # that they cost next to nothing either way.
+        self.__stats = None
+        if collectStats:
+            self.__stats = {"evictions": 0, "chainLengths": {}, 
+                            "failedPlacements": 0, "grows": 0, 
+                            "rehashes": 0}
+        self.__onResize = onResize
+        
+        # In a thread-safe table, each stripe of buckets has a lock, which 
+        # writers hold while they change any of its buckets, and a version 
+        # number, which writers make odd while they change the stripe and 
+        # even again once they are done. __epoch is the version number of the
+        # whole table, which is odd while it resizes.
+        self.__locks = None
+        if threadSafe:
+            self.__locks = [threading.Lock() for i in range(_NUM_STRIPES)]
+            self.__versions = [0] * _NUM_STRIPES
+            self.__epoch = 0
+            self.__countLock = threading.Lock()
         
+        self.__allocate(size)
+        
+    # Create new, empty arrays of size slots each (rounded up to a whole 
+    # number of buckets). The stash is kept in stashSize extra slots at the 
+    # end of the flat arrays, after the slots of the hash arrays. The miss
+    # summary, if any, has 4 one-byte counters per slot of the hash arrays.
+    def __allocate(self, size):
+        self.__numBuckets = -(-size // self.__bucketSize)  # ceil
+        numSlots = self.__numTables * self.__numBuckets * self.__bucketSize
+        self.__numSlots = numSlots
+        self.__maxKeys = max(1, int(self.__maxLoadFactor * numSlots))
+        self.__minKeys = int(self.__minLoadFactor * numSlots)
+        self.__summary = None
+        if self.__missSummary: self.__summary = bytearray(4 * numSlots)
+        numSlots += self.__stashSize
+        self.__refBits = bytearray(numSlots) if self.__cache else None
+        self.__hand = 0
+        self.__keys = [_EMPTY] * numSlots
+        self.__data = [None] * numSlots
+        self.__hashes = array('Q', bytes(8 * numSlots))
+        self.__numKeys = 0
+        self.__numStashed = 0
+
     # Return how many keys have been inserted into the CuckooHash    
-    def __len__(self): return self.__numKeys 
+    def __len__(self): 
+        if self.__old is not None: return self.__numKeys + self.__old.__numKeys
+        return self.__numKeys
+    
+    # Return the total number of slots in all hash arrays (not counting the 
+    # stash, or the old arrays during an incremental resize)
+    def capacity(self): return self.__numSlots
+    
+    # Return the fraction of slots currently in use
+    def loadFactor(self): return self.__numKeys / self.__numSlots
+    
+    # Return how many entries are in the stash
+    def stashed(self): return self.__numStashed
+    
+    # Return a dict describing the table: its number of keys, capacity, load
+    # factor, number of stashed entries, and "keysPerTable", the number of 
+    # keys stored in each hash array (a key in array i is found after 
+    # probing i buckets). During an incremental resize, the stashed entries 
+    # and the keys in array i of both the old and the new arrays are counted,
+    # so that the keys per array and the stashed entries add up to the 
+    # number of keys. If the table was made with collectStats=True,
+    # the dict also has the number of entries evicted, a histogram of 
+    # eviction chain lengths (mapping each length to how many chains had it),
+    # how many chains failed to place their last entry, and how many times 
+    # the table grew and drew new hash functions to rehash. The dict of a 
+    # cache also has its number of hits and misses, and of "cacheEvictions",
+    # the entries it evicted or dropped to make room for new ones.
+    def stats(self):
+        keysPerTable = [0] * self.__numTables
+        stashed = 0
+        for c in self.__generations():
+            keys, arrSlots = c.__keys, c.__numBuckets * c.__bucketSize
+            for i in range(c.__numTables):
+                keysPerTable[i] += sum(keys[slot] is not _EMPTY for slot in 
+                                       range(i*arrSlots, (i+1)*arrSlots))
+            stashed += c.__numStashed
+        s = {"numKeys": len(self), "capacity": self.capacity(), 
+             "loadFactor": self.loadFactor(), "stashed": stashed,
+             "keysPerTable": keysPerTable}
+        if self.__stats is not None:
+            s.update(self.__stats)
+            s["chainLengths"] = dict(self.__stats["chainLengths"])
+        if self.__cache:
+            s.update(hits = self.__hits, misses = self.__misses,
+                     cacheEvictions = self.__cacheEvictions)
+        return s
+    
+    # Return True if an incremental resize is in progress, i.e. some entries
+    # are still in the old arrays.
+    def isResizing(self): return self.__old is not None
+    
+    # Return the CuckooHash objects holding the entries: this one and, during
+    # an incremental resize, the one holding the old arrays.
+    def __generations(self):
+        if self.__old is not None: return (self, self.__old)
+        return (self,)
+    
+    # Given a hash value and an array number, return the first slot of the 
+    # bucket that the hash value maps to in that array.
+    def __bucketStart(self, h, arrNum):
+        return ((arrNum-1) * self.__numBuckets + h % self.__numBuckets) * \
+               self.__bucketSize
+    
+    # Return a list with a key's hash value for each array, given the key's 
+    # base hash.
+    def __hashesOf(self, b):
+        hashFromBase = self.__hashFamily.hashFromBase
+        return [hashFromBase(b, arrNum) 
+                for arrNum in range(1, self.__numTables+1)]
+
+    # Given a key, return the slot it occupies in the flat arrays, or -1 if
+    # the key is not in the CuckooHash.
+    def __findSlot(self, k):
+        # Compute the key's base hash, which is the only time the key itself
+        # is hashed.
+        return self.__findBaseSlot(k, self.__hashFamily.baseHash(k))
+    
+    # Same as __findSlot, given the key's base hash.
+    def __findBaseSlot(self, k, b):
+        # Try to find the given key in array 1 by deriving its hash value for
+        # array 1 from its base hash and looking at each slot of the 
+        # corresponding bucket in the array. The cached base hash is compared
+        # first, so that most non-matching slots are rejected without 
+        # comparing keys. If they key could not be found in array 1, try with
+        # array 2, and so on.
+        hashFromBase = self.__hashFamily.hashFromBase
+        summary = self.__summary
+        if summary is not None and not summary[hashFromBase(b, 1) % 
+                                               len(summary)]:
+            return -1
+        for arrNum in range(1, self.__numTables+1):
+            start = self.__bucketStart(hashFromBase(b, arrNum), arrNum)
+            for slot in range(start, start + self.__bucketSize):
+                if self.__hashes[slot] == b and self.__keys[slot] == k: 
+                    return slot
+        
+        # If the key could not be found in any array, look in the stash, 
+        # or return -1 if it is not there either.
+        return self.__findStashSlot(k, b)
+    
+    # Given a key and its base hash, return the slot it occupies in the 
+    # stash, or -1 if the key is not in the stash.
+    def __findStashSlot(self, k, b):
+        if self.__numStashed:
+            for slot in range(self.__numSlots, len(self.__keys)):
+                if self.__hashes[slot] == b and self.__keys[slot] == k: 
+                    return slot
+        return -1
+    
+    # Same as __findSlot, given the key's base hash and the list of its hash
+    # values for each array, which have already been computed.
+    def __findHashedSlot(self, k, b, hashes):
+        summary = self.__summary
+        if summary is not None and not summary[hashes[0] % len(summary)]:
+            return -1
+        for arrNum in range(1, self.__numTables+1):
+            start = self.__bucketStart(hashes[arrNum-1], arrNum)
+            for slot in range(start, start + self.__bucketSize):
+                if self.__hashes[slot] == b and self.__keys[slot] == k: 
+                    return slot
+        return self.__findStashSlot(k, b)
+    
+    # Given a list of keys, return a list of the slots they occupy (or -1 for
+    # the keys that are not in the CuckooHash). When NumPy is available the
+    # base hashes and hash values of all the keys are computed, and compared
+    # against the cached base hashes of their buckets, with array operations,
+    # and only the keys of the matching slots are compared one by one.
+    def __findSlots(self, keys):
+        if not self.__vectorized or not keys: 
+            return [self.__findSlot(k) for k in keys]
+        
+        b, numBuckets = self.__bucketSize, self.__numBuckets
+        cached = numpy.frombuffer(self.__hashes, dtype=numpy.uint64)
+        found = numpy.full(len(keys), -1, dtype=numpy.int64)
+        base = self.__hashFamily.baseHashArray(keys)
+        for arrNum in range(1, self.__numTables+1):
+            h = self.__hashFamily.hashFromBaseArray(base, arrNum)
+            start = ((arrNum-1) * numBuckets + 
+                     (h % numpy.uint64(numBuckets)).astype(numpy.int64)) * b
+            for j in range(b):
+                match = (found < 0) & (cached[start + j] == base)
+                found[match] = start[match] + j
         
+        # Confirm that each matching slot holds the key itself, falling back
+        # to __findSlot in the (very unlikely) event that it does not, and 
+        # look for the keys that were not found in the stash, if it is not
+        # empty.
+        slots = found.tolist()
+        for i, slot in enumerate(slots):
+            if slot >= 0 and self.__keys[slot] != keys[i] or \
+               slot < 0 and self.__numStashed: 
+                slots[i] = self.__findSlot(keys[i])
+        return slots
+    
+    # Given a hash value and an array number, return an empty slot in the 
+    # bucket that the hash value maps to, or -1 if the bucket is full.
+    def __emptySlot(self, h, arrNum):
+        start = self.__bucketStart(h, arrNum)
+        for slot in range(start, start + self.__bucketSize):
+            if self.__keys[slot] is _EMPTY: return slot
+        return -1
+    
+    # Store the given key, data and base hash in the given slot.
+    def __store(self, slot, k, d, b):
+        self.__keys[slot] = k
+        self.__data[slot] = d
+        self.__hashes[slot] = b
+
     # Given a key, search the CuckooHash arrays for the data associated with it.
-    # If the key can be found, return its data. Otherwise return None.
-    def find(self, k):
-        # Try to find the given key in array 1 by hashing the key and looking
-        # at the corresponding position in the array. If found, return its data.
-        pos = BitHash(k, 1) % len(self.__hashArr1)
-        n = self.__hashArr1[pos]
-        if n and n.key == k: return n.data
-        
-        # If they key could not be found find in array 1, try with array 2.
-        pos = BitHash(k, 2) % len(self.__hashArr2)
-        n = self.__hashArr2[pos]
-        if n and n.key == k: return n.data
-        
-        # If the key could not be found in either, return None
-        return None
+    # If the key can be found, return its data. Otherwise return default.
+    def find(self, k, default = None):
+        if self.__locks is not None: return self.__findOptimistic(k, default)
+        if self.__old is not None: return self.__findResizing(k, default)
+        slot = self.__findSlot(k)
+        if self.__refBits is not None: self.__countLookup(slot)
+        if slot < 0: return default
+        return self.__data[slot]
+    get = find
+    
+    # Count a lookup of a cache that found its key in the given slot (or 
+    # didn't, if slot is -1), and mark the slot's entry as recently used.
+    def __countLookup(self, slot):
+        if slot < 0: 
+            self.__misses += 1
+            return
+        self.__hits += 1
+        self.__refBits[slot] = 1
+    
+    # find, during an incremental resize: move a few entries to the new 
+    # arrays, and look for the key in the new arrays and then in the old ones.
+    def __findResizing(self, k, default = None):
+        self.__migrate()
+        b = self.__hashFamily.baseHash(k)
+        for c in self.__generations():
+            slot = c.__findBaseSlot(k, b)
+            if slot >= 0: return c.__data[slot]
+        return default
+    
+    # Return the data of key k, or raise KeyError if k is not in the table
+    def __getitem__(self, k):
+        d = self.find(k, _EMPTY)
+        if d is _EMPTY: raise KeyError(k)
+        return d
+    
+    # Return True if key k is in the table
+    def __contains__(self, k): return self.find(k, _EMPTY) is not _EMPTY
+    
+    # Associate data d with key k: replace the data of k in its slot if k is
+    # already in the table, or else insert a new entry.
+    def __setitem__(self, k, d):
+        if self.__locks is not None: return self.__setLocked(k, d)
+        b = self.__hashFamily.baseHash(k)
+        for c in self.__generations():
+            slot = c.__findBaseSlot(k, b)
+            if slot >= 0: 
+                c.__data[slot] = d
+                self.__logChange("set", k, d)
+                return
+        self.__insertHashed(k, d, b, self.__hashesOf(b))
+    
+    # Delete key k, or raise KeyError if k is not in the table
+    def __delitem__(self, k):
+        if self.delete(k) is None: raise KeyError(k)
     
-    # Insert a new node with the given key and data.
+    # Delete key k and return its data. If k is not in the table, return 
+    # default if it is given, or else raise KeyError.
+    def pop(self, k, *default):
+        n = self.delete(k)
+        if n is not None: return n[1]
+        if default: return default[0]
+        raise KeyError(k)
+    
+    # Delete every entry, keeping the current capacity
+    def clear(self):
+        def empty():
+            self.__old = None
+            self.__allocate(self.__numBuckets * self.__bucketSize)
+            self.__logChange("clear")
+        if self.__locks is None: empty()
+        else: self.__exclusive(empty)
+
+    # Insert a new entry with the given key and data.
     def insert(self, k, d):
-        # Return False if key is already in either hash array
-        if self.find(k): return False
+        if self.__locks is not None: return self.__insertLocked(k, d)
+        b = self.__hashFamily.baseHash(k)
+        return self.__insertHashed(k, d, b, self.__hashesOf(b))
+    
+    # Insert a new entry with the given key and data, given the key's base 
+    # hash and the list of its hash values for each array.
+    def __insertHashed(self, k, d, b, hashes):
+        # Return False if key is already in any hash array (or, during an
+        # incremental resize, in the old arrays)
+        if self.__findHashedSlot(k, b, hashes) >= 0: return False
+        if self.__old is not None:
+            if self.__old.__findBaseSlot(k, b) >= 0: return False
+            self.__migrate()
 
         # If the arrays are getting too full, i.e. the amount of keys is more
-        # than half the underlying storage, grow them and then try insert.
-        if self.__numKeys >= len(self.__hashArr1): self.__grow()
+        # than the maximum load factor allows, grow them (or for a cache, 
+        # evict an entry) and then try insert.
+        if self.__numKeys >= self.__maxKeys: 
+            if self.__cache: self.__evict()
+            else: self.__grow()
         
-        # Create a new Node with the key-data pair
-        n = Node(k, d)
+        self.__add(k, d, b)
+        self.__logChange("insert", k, d)
+        return True
+    
+    # Place a new entry in the arrays, and count it. If placing it failed 
+    # because we ran into an infinite eviction loop, keep the most recently
+    # displaced entry in the stash if there is room for it. Otherwise, the
+    # solution is to rehash, grow all arrays, and reinsert everything along
+    # with the most recently displaced entry.
+    # The new key is counted in the miss summary before it is placed, and 
+    # growing counts the displaced entry again along with the others.
+    # A cache evicts entries instead of growing, but never the new entry 
+    # itself (see __cacheDisplaced).
+    # If growing fails (see _RESIZE_TRIES), it raises RuntimeError, and the
+    # displaced entry (the new one, or one that it evicted) is lost.
+    def __add(self, k, d, b):
+        self.__countKey(b, 1)
+        entry = self.__place(k, d, b)
+        tries = 0
+        while entry and not self.__stash(*entry):
+            if self.__cache:
+                if tries == _CACHE_TRIES: 
+                    self.__cacheDisplaced(entry, k, b)
+                    break
+                tries += 1
+                self.__evict(self.__findBaseSlot(k, b))
+                entry = self.__place(*entry)
+                continue
+            self.__grow(entry)
+            break
+        self.__numKeys += 1
+    
+    # Make room in a cache for the entry left without a place by inserting 
+    # key k (whose base hash is b), after evicting a few entries (keeping 
+    # the new one) did not help. If it is the new entry, it takes the place
+    # of an entry of its first bucket, preferably one without a reference
+    # bit. Otherwise, it is dropped.
+    def __cacheDisplaced(self, entry, k, b):
+        self.__cacheEvictions += 1
+        if entry[2] != b or entry[0] != k:
+            self.__countKey(entry[2], -1)
+            self.__numKeys -= 1
+            return
+        slot = self.__bucketStart(self.__hashFamily.hashFromBase(b, 1), 1)
+        for s in range(slot, slot + self.__bucketSize):
+            if not self.__refBits[s]: 
+                slot = s
+                break
+        self.__clear(slot)
+        self.__store(slot, *entry)
+    
+    # Add delta (1 or -1) to the miss summary counter of the key with base 
+    # hash b, if the table keeps a miss summary. A counter that reached 255
+    # stays there for good, since it no longer knows how many keys it counts.
+    def __countKey(self, b, delta):
+        summary = self.__summary
+        if summary is None: return
+        i = self.__hashFamily.hashFromBase(b, 1) % len(summary)
+        if summary[i] < 255: summary[i] += delta
         
-        # Starting with the first array
-        arr, arrNum = self.__hashArr1, 1
-        # for no more than 16 total loops
-        for i in range(16):
-            # Hash the key into the current array
-            pos = BitHash(n.key, arrNum) % len(arr)
-            # if the position in current array is empty, insert, increment 
-            # numKeys, and return True
-            if not arr[pos]: 
-                arr[pos] = n
-                self.__numKeys += 1
+    # Put an entry in an empty slot of the stash, and return True, or return
+    # False if the stash is full.
+    def __stash(self, k, d, b):
+        if self.__numStashed == self.__stashSize: return False
+        for slot in range(self.__numSlots, len(self.__keys)):
+            if self.__keys[slot] is _EMPTY:
+                self.__store(slot, k, d, b)
+                self.__numStashed += 1
                 return True                      
+    
+    # Place an entry with the given key, data and base hash in the arrays, 
+    # without checking whether the key is already there or the arrays are 
+    # too full. Return None if all entries have been placed, or the 
+    # (key, data, base hash) of the entry left without a slot if we ran into
+    # an infinite eviction loop. Evicted entries are moved using their cached
+    # base hash, so no key is ever hashed again here.
+    def __place(self, k, d, b):
+        hashFromBase = self.__hashFamily.hashFromBase
+        keys, numBuckets, bucketSize = \
+            self.__keys, self.__numBuckets, self.__bucketSize
+        
+        # If any of the key's candidate buckets has an empty slot, insert 
+        # there and return None. (This is by far the most common case, so
+        # the bucket positions are computed inline rather than by calling
+        # __emptySlot.)
+        for arrNum in range(1, self.__numTables+1):
+            start = ((arrNum-1) * numBuckets + 
+                     hashFromBase(b, arrNum) % numBuckets) * bucketSize
+            for slot in range(start, start + bucketSize):
+                if keys[slot] is _EMPTY:
+                    self.__store(slot, k, d, b)
+                    return None
+        
+        if self.__bfs: return self.__placeBFS(k, d, b)
+
+        # A cache's reference bits move along with the entries (r is the bit
+        # of the entry in hand)
+        refBits, r = self.__refBits, 0
+
+        # Starting with the first array
+        arrNum = 1
+        # for no more than maxLoop total loops
+        for i in range(self.__maxLoop):
+            # if the bucket in current array has an empty slot, insert and
+            # return None
+            h = hashFromBase(b, arrNum)
+            slot = self.__emptySlot(h, arrNum)
+            if slot >= 0:
+                self.__store(slot, k, d, b)
+                if refBits is not None: refBits[slot] = r
+                if self.__stats is not None: self.__countChain(i)
+                return None
+
+            # If the bucket is full, push the entry into one of its slots 
+            # (chosen at random when there is more than one) and attempt to 
+            # reinsert the evicted entry into another array (chosen at random
+            # when there are more than two) by changing arrNum and looping 
+            # again.
+            # The loop will stop either when all entries have been successfully
+            # inserted or if there is an infinite eviction loop.
+            slot = self.__bucketStart(h, arrNum)
+            if self.__bucketSize > 1: 
+                slot += random.randrange(self.__bucketSize)
+            self.__keys[slot], k = k, self.__keys[slot]
+            self.__data[slot], d = d, self.__data[slot]
+            self.__hashes[slot], b = b, self.__hashes[slot]
+            if refBits is not None: refBits[slot], r = r, refBits[slot]
+            if self.__numTables == 2: arrNum = 2 if arrNum == 1 else 1
+            else: 
+                arrNum = 1 + (arrNum + random.randrange(self.__numTables-1)) \
+                             % self.__numTables
+
+        # If we've made it here, we ran into an infinite eviction loop
+        if self.__stats is not None: self.__countChain(self.__maxLoop, True)
+        return (k, d, b)
+    
+    # Count an eviction chain of the given length, and whether it failed to
+    # find a place for the last evicted entry.
+    def __countChain(self, length, failed = False):
+        stats = self.__stats
+        stats["evictions"] += length
+        stats["chainLengths"][length] = stats["chainLengths"].get(length,0) + 1
+        if failed: stats["failedPlacements"] += 1
+    
+    # Place an entry whose candidate buckets are all full by searching 
+    # breadth-first for the shortest chain of evictions that ends in an empty
+    # slot, and only then moving the entries along it. If no chain is found,
+    # nothing is moved and the entry is returned.
+    def __placeBFS(self, k, d, b):
+        path = self.__findPath(b)
+        if path is None:
+            if self.__stats is not None: self.__countChain(0, True)
+            return (k, d, b)
+        
+        self.__movePath(path, k, d, b)
+        if self.__stats is not None: self.__countChain(len(path)-1)
+        return None
+    
+    # Given the base hash of an entry whose candidate buckets are all full,
+    # search breadth-first, visiting at most 4*maxLoop slots, for the 
+    # shortest chain of evictions that ends in an empty slot. Return the 
+    # slots along the chain, starting with a slot of one of the entry's 
+    # buckets and ending with the empty slot, or None if there is none.
+    def __findPath(self, b):
+        hashFromBase = self.__hashFamily.hashFromBase
+        keys, hashes = self.__keys, self.__hashes
+        numBuckets, bucketSize = self.__numBuckets, self.__bucketSize
+        arrSlots = numBuckets * bucketSize
+        
+        # The search starts from every slot of the entry's candidate buckets
+        parent = {}
+        for arrNum in range(1, self.__numTables+1):
+            start = self.__bucketStart(hashFromBase(b, arrNum), arrNum)
+            for slot in range(start, start + bucketSize): parent[slot] = -1
+        queue = deque(parent)
+        
+        # From each full slot, look at the other candidate buckets of the 
+        # entry stored there
+        while queue and len(parent) < 4 * self.__maxLoop:
+            slot = queue.popleft()
+            h = hashes[slot]
+            for arrNum in range(1, self.__numTables+1):
+                if arrNum == slot // arrSlots + 1: continue
+                start = ((arrNum-1) * numBuckets + 
+                         hashFromBase(h, arrNum) % numBuckets) * bucketSize
+                for dest in range(start, start + bucketSize):
+                    if dest in parent: continue
+                    parent[dest] = slot
+                    if keys[dest] is not _EMPTY: 
+                        queue.append(dest)
+                        continue
+                    
+                    # Each slot searched was reached from the slot whose 
+                    # entry would be evicted into it, so follow those back 
+                    # from the empty slot to the start of the chain.
+                    path = [dest]
+                    while slot >= 0:
+                        path.append(slot)
+                        slot = parent[slot]
+                    path.reverse()
+                    return path
+        return None
+    
+    # Move each entry along the given chain of slots one step towards the 
+    # empty slot at its end, starting from the far end, then store the given
+    # entry at its start. Each entry is copied into its new slot before its 
+    # old slot is overwritten, so an entry is never missing from the arrays.
+    def __movePath(self, path, k, d, b):
+        keys, data, hashes = self.__keys, self.__data, self.__hashes
+        refBits = self.__refBits
+        for i in range(len(path)-1, 0, -1):
+            src = path[i-1]
+            self.__store(path[i], keys[src], data[src], hashes[src])
+            if refBits is not None: refBits[path[i]] = refBits[src]
+        self.__store(path[0], k, d, b)
+        if refBits is not None: refBits[path[0]] = 0
+
+    # Insert every key-data pair from the given iterable of pairs (or from the
+    # given mapping), and return how many new keys were inserted. The arrays
+    # are grown at most once, up front, to fit all of the pairs, instead of 
+    # being grown by 1.5 over and over while the pairs are inserted.
+    def insertMany(self, pairs):
+        if hasattr(pairs, "items"): pairs = pairs.items()
+        if not isinstance(pairs, list): pairs = list(pairs)
+        
+        # If the pairs would push the arrays past the maximum load factor,
+        # resize them right away to the size needed to hold all the keys, 
+        # with 10% to spare so that the last few inserts are unlikely to run
+        # into an eviction loop and grow the arrays yet again. (A bulk insert
+        # is not expected to return quickly, so any incremental resize is 
+        # finished first, and this resize is not incremental.)
+        numKeys = len(self) + len(pairs)
+        if int(numKeys * 1.1) > self.__maxKeys and not self.__cache:
+            self.__finishMigration()
+            size = self.__sizeFor(numKeys, 1/1.1)
+            if self.__locks is None: self.__resize(size)
+            else: self.__exclusive(self.__resize, size)
+        
+        # Insert each pair, counting how many of them were new keys
+        insert = self.insert
+        count = 0
+        for k, d in pairs:
+            if insert(k, d): count += 1
+        return count
+    
+    # Given an iterable of keys, return a list with the data associated with
+    # each key, or None for the keys that are not in the CuckooHash.
+    def findMany(self, keys):
+        keys = list(keys)
+        if self.__locks is not None or self.__cache: 
+            return [self.find(k) for k in keys]
+        
+        # During an incremental resize, move a few entries first (which may
+        # even replace the arrays, if placing one of them fails), and then
+        # look for the keys missing from the new arrays in the old ones.
+        if self.__old is not None: self.__migrate()
+        data, old = self.__data, self.__old
+        if old is None:
+            return [data[slot] if slot >= 0 else None 
+                    for slot in self.__findSlots(keys)]
+        return [data[slot] if slot >= 0 else old.find(k) 
+                for k, slot in zip(keys, self.__findSlots(keys))]
+    
+    # Given an iterable of keys, return a list of bools telling whether each 
+    # key is in the CuckooHash.
+    def containsMany(self, keys):
+        keys = list(keys)
+        if self.__locks is not None or self.__cache: 
+            return [self.find(k, _EMPTY) is not _EMPTY for k in keys]
+        if self.__old is not None: self.__migrate()
+        old = self.__old
+        if old is None: return [slot >= 0 for slot in self.__findSlots(keys)]
+        return [slot >= 0 or old.__findSlot(k) >= 0
+                for k, slot in zip(keys, self.__findSlots(keys))]
+
+    # Grow the arrays by 1.5 (as not to be too crazy with the amount of 
+    # storage we are using up), and rehash and reinsert everything, or with 
+    # an incremental resize, start moving everything to the new arrays.
+    # The new arrays can only need to grow during an incremental resize if 
+    # resizeStep is very small, or if placing an entry failed, and they 
+    # can't take the rest of the old entries then, so the entries of both
+    # the old and the new arrays are rehashed into bigger arrays at once.
+    # The given (key, data, base hash) entry, if any, which is not in the 
+    # arrays, is placed in the new arrays too (and counted in their miss 
+    # summary).
+    def __grow(self, entry = None):
+        if self.__stats is not None: self.__stats["grows"] += 1
+        size = self.__numBuckets * self.__bucketSize * 1.5
+        if self.__resizeStep is None or self.__old is not None: 
+            self.__resize(size, entry)
+        else: 
+            # An entry always has a place in the new, empty arrays
+            self.__startResize(size)
+            if entry:
+                self.__countKey(entry[2], 1)
+                self.__place(*entry)
+    
+    # Start an incremental resize to new arrays of size slots each.
+    def __startResize(self, size):
+        # Keep the current arrays and hash functions in a CuckooHash of their
+        # own. This CuckooHash gets new, empty arrays with new hash functions
+        # that share the same base hash, so the cached base hashes of the old
+        # entries can be used to place them in the new arrays.
+        self.__old = copy.copy(self)
+        self.__cursor = 0
+        self.__hashFamily = self.__hashFamily.spawn()
+        self.__allocate(int(size))
+        if self.__onResize: 
+            self.__onResize(self.__old.__numSlots, self.__numSlots)
+    
+    # Move every entry to new arrays of size slots each (by default, the 
+    # current size) with new hash functions. If the table resizes 
+    # incrementally, this only starts the resize, which the following 
+    # operations (or continueResize) carry on.
+    def rehash(self, size = None):
+        if size is None: size = self.__numBuckets * self.__bucketSize
+        if self.__locks is not None: self.__exclusive(self.__resize, size)
+        elif self.__resizeStep is None or self.__old is not None: 
+            self.__resize(size)
+        else: self.__startResize(size)
+    
+    # Return the size (in slots per array) of arrays holding numKeys keys (or
+    # the keys in the table, if there are more) at fraction load of the 
+    # maximum load factor. This picks the new size of the arrays whenever it
+    # is not just 1.5 times the old one: for insertMany, reserve, compact, 
+    # and shrinking after a delete.
+    def __sizeFor(self, numKeys, load):
+        numKeys = max(numKeys, len(self), 1)
+        return numKeys / (self.__maxLoadFactor * load * self.__numTables) + 1
+    
+    # Make room for n keys in all, so that the table doesn't grow while they
+    # are inserted, e.g. before a bulk load of a known size. The arrays 
+    # are resized (just like rehash would) only if they are too small.
+    def reserve(self, n):
+        if int(n * 1.1) > self.__maxKeys: self.rehash(self.__sizeFor(n, 1/1.1))
+    
+    # Resize the arrays (just like rehash would) to the size they would have
+    # right after growing to hold the keys in the table, e.g. to give memory
+    # back after many deletes.
+    def compact(self): self.rehash(self.__sizeFor(len(self), 1/1.5))
+    
+    # During an incremental resize, move up to step entries (by default, 
+    # resizeStep) to the new arrays. Return True if the resize is still in
+    # progress afterwards.
+    def continueResize(self, step = None):
+        if self.__old is not None: self.__migrate(step)
+        return self.__old is not None
+        
+    # Move up to resizeStep entries from the old arrays to the new arrays, 
+    # looking at no more than 4*resizeStep slots of the old arrays, and stop
+    # the incremental resize once the old arrays are empty.
+    def __migrate(self, step = None):
+        if step is None: step = self.__resizeStep
+        old = self.__old
+        keys = old.__keys
+        end = min(len(keys), self.__cursor + 4*step)
+        
+        while self.__cursor < end and step > 0:
+            slot = self.__cursor
+            self.__cursor += 1
+            if keys[slot] is _EMPTY: continue
+            
+            # Empty the old slot, then place the entry in the new arrays
+            k, d, b = keys[slot], old.__data[slot], old.__hashes[slot]
+            old.__clear(slot)
+            self.__add(k, d, b)
+            step -= 1
             
-            # If the position is filled, push n into that position and
-            # attempt to reinsert the evicted Node into the other array by 
-            # changing the arr and arrNum pointers and looping again.
-            # The loop will stop either when all Nodes have been successfully 
-            # inserted and the method returns True or if there is an infinite 
-            # eviction loop.
-            arr[pos], n = n, arr[pos]
-            if arrNum == 1: arr, arrNum = self.__hashArr2, 2
-            else:           arr, arrNum = self.__hashArr1, 1 
-           
-        # If we've made it here, insertion has failed because we ran into an
-        # infinite eviction loop. Solution: rehash, grow both arrays, and 
-        # reinsert everything. Then reattmept the insert with the most recently
-        # displaced Node.
-        self.__grow()
-        self.insert(n.key, n.data)
-    
-    # Grow the arrays, reset bithash, rehash and reinsert everything.
-    def __grow(self):
-        # Reset the bit hash
-        ResetBitHash()
-        
-        # Increase the size of the arrays by 1.5 (as not to be too crazy with
-        # the amount of storage we are using up).
-        size = int(len(self.__hashArr1)*1.5)
-        
-        # Create a temporary CuckooHash object of size array length
-        temp = CuckooHash(size)
-        
-        # for each Node in both arrays, insert into temp
-        for i in range(len(self.__hashArr1)):
-            if self.__hashArr1[i]: 
-                temp.insert(self.__hashArr1[i].key, self.__hashArr1[i].data)
-            if self.__hashArr2[i]: 
-                temp.insert(self.__hashArr2[i].key, self.__hashArr2[i].data)
-                                
-        # Set the arrays to point to the new arrays.
-        self.__hashArr1 = temp.__hashArr1
-        self.__hashArr2 = temp.__hashArr2
-        temp = None  # Garbage collect temp
-
-    
-    # Given a key, find and delete the corresponding Node, and return the key
+            # If placing the entry made the new arrays grow, this resize has
+            # already been finished.
+            if self.__old is not old: return
+            
+        if self.__cursor >= len(keys): self.__old = None
+    
+    # Move all the remaining entries of an incremental resize, if any, to the
+    # new arrays.
+    def __finishMigration(self):
+        while self.__old is not None: self.__migrate(len(self.__old.__keys))
+
+    # Resize the arrays to size slots each, rehash with new hash functions and
+    # reinsert everything (including, during an incremental resize, the 
+    # entries still in the old arrays, which ends that resize), along with 
+    # the given (key, data, base hash) entry, if any, which is not in the 
+    # arrays. Entries are placed using their cached base hashes, so resizing
+    # never hashes a key again.
+    def __resize(self, size, entry = None):
+        arrays = [(c.__keys, c.__data, c.__hashes) 
+                  for c in self.__generations()]
+        if entry: arrays.append(tuple([x] for x in entry))
+        numKeys, oldCapacity = len(self), self.__numSlots
+        before = copy.copy(self)
+        self.__old = None
+        self.__hashFamily = self.__hashFamily.spawn()
+        
+        # Draw new hash functions and place each entry of the old arrays (and
+        # of the old stash) into new, empty arrays. An entry that can't be 
+        # placed goes into the stash, and if the stash is full, try again 
+        # with new hash functions and arrays 1.5 times bigger. If that keeps
+        # failing, put the table back the way it was and give up.
+        for i in range(_RESIZE_TRIES):
+            if self.__stats is not None: self.__stats["rehashes"] += 1
+            if i: self.__hashFamily.reset()
+            self.__allocate(int(size))
+            if all(self.__placeAll(*a) for a in arrays): break
+            size *= 1.5
+        else:
+            self.__dict__.update(before.__dict__)
+            raise RuntimeError("could not place the keys in %d resizes; too "
+                               "many keys have the same base hash" % 
+                               _RESIZE_TRIES)
+        self.__numKeys = numKeys
+        
+        # The hash functions changed, so count every key in the new summary
+        if self.__summary is not None:
+            for slot, b in enumerate(self.__hashes):
+                if self.__keys[slot] is not _EMPTY: self.__countKey(b, 1)
+        if self.__onResize: self.__onResize(oldCapacity, self.__numSlots)
+
+
+    # Place every entry of the given key, data and base hash arrays in the 
+    # arrays, stashing those that can't be placed. Return False if an entry
+    # could be neither placed nor stashed.
+    def __placeAll(self, keys, data, hashes):
+        for slot in range(len(keys)):
+            if keys[slot] is _EMPTY: continue
+            entry = self.__place(keys[slot], data[slot], hashes[slot])
+            if entry and not self.__stash(*entry): return False
+        return True
+
+    # Given a key, find and delete the corresponding entry, and return the key
     # data pair as a tuple. Otherwise, return None.
     def delete(self, k):
-        # Try to find the given key in array 1 by hashing the key and looking
-        # at the corresponding position in the array. If found, set
-        # that pos in the array to None and return the deleted key-data pair.
-        pos = BitHash(k, 1) % len(self.__hashArr1)
-        n = self.__hashArr1[pos]
-        if n and n.key == k: 
-            self.__hashArr1[pos] = None
-            self.__numKeys -= 1
-            return (n.key, n.data)
+        if self.__locks is not None: return self.__deleteLocked(k)
         
-        # If could not be found in array 1, try to find in array 2 and delete.
-        pos = BitHash(k, 2) % len(self.__hashArr2)
-        n = self.__hashArr2[pos]
-        if n and n.key == k: 
-            self.__hashArr2[pos] = None
-            self.__numKeys -= 1
-            return (n.key, n.data)
+        # During an incremental resize, move a few entries, and if the key is
+        # not in the new arrays, delete it from the old ones. Nothing is 
+        # unstashed into the old arrays, since it might land in a slot that
+        # has already been migrated.
+        if self.__old is not None:
+            self.__migrate()
+            old = self.__old
+            if old is not None and self.__findSlot(k) < 0: 
+                slot = old.__findSlot(k)
+                if slot < 0: return None
+                n = (old.__keys[slot], old.__data[slot])
+                old.__clear(slot)
+                self.__logChange("delete", k)
+                return n
+            
+        # Find the slot holding the key. If found, empty that slot and return
+        # the deleted key-data pair.
+        slot = self.__findSlot(k)
+        if slot < 0: return None
+
+        n = (self.__keys[slot], self.__data[slot])
+        self.__clear(slot)
+        self.__logChange("delete", k)
         
-        # if could not find in either, do nothing and return None.
+        # A slot in the hash arrays has been freed, so it may now be possible
+        # to place an entry from the stash.
+        if self.__numStashed and slot < self.__numSlots: self.__unstash()
         
-    # Accessor str method for printing the CuckooHash object Nodes
-    def __str__(self):
-        # create a list of all Nodes from both arrays
-        temp = []
-        for i in range(len(self.__hashArr1)):
-            n = self.__hashArr1[i]
-            if n: temp += [(n.key, n.data)]
-            n = self.__hashArr2[i]
-            if n: temp += [(n.key, n.data)]
+        # Shrink the arrays if they are too empty now (unless they are the 
+        # new arrays of an incremental resize, which are still filling up)
+        if self.__numKeys < self.__minKeys and self.__old is None: 
+            self.compact()
+        return n
+    
+    # Empty the given slot (of the hash arrays or of the stash), and stop 
+    # counting its entry.
+    def __clear(self, slot):
+        self.__countKey(self.__hashes[slot], -1)
+        if self.__refBits is not None: self.__refBits[slot] = 0
+        self.__keys[slot] = _EMPTY
+        self.__data[slot] = None
+        self.__hashes[slot] = 0
+        self.__numKeys -= 1
+        if slot >= self.__numSlots: self.__numStashed -= 1
+    
+    # Evict an entry from a full cache, chosen by the CLOCK policy, which 
+    # approximates evicting the least recently used entry: the hand goes 
+    # around the slots (of the arrays and the stash), clearing the reference
+    # bit of each entry that has one, i.e. that was found since the hand last
+    # passed it, and evicts the first entry that has none. New entries start
+    # without a reference bit, so an entry that is never found is evicted 
+    # the first time the hand comes by. (An entry moved by an eviction chain
+    # takes its bit along, but the hand may pass it twice or not at all in 
+    # one round.) The entry in slot keep, if any, is never evicted.
+    def __evict(self, keep = -1):
+        keys, refBits = self.__keys, self.__refBits
+        hand = self.__hand
+        while True:
+            hand = (hand + 1) % len(keys)
+            if keys[hand] is _EMPTY or hand == keep: continue
+            if not refBits[hand]: break
+            refBits[hand] = 0
+        self.__hand = hand
+        self.__clear(hand)
+        self.__cacheEvictions += 1
+        if self.__numStashed and hand < self.__numSlots: self.__unstash()
+    
+    # Take one entry out of the stash and try to place it in the hash arrays,
+    # putting whichever entry ends up displaced back in the stash.
+    def __unstash(self):
+        for slot in range(self.__numSlots, len(self.__keys)):
+            if self.__keys[slot] is not _EMPTY:
+                entry = (self.__keys[slot], self.__data[slot], 
+                         self.__hashes[slot])
+                self.__clear(slot)
+                self.__numKeys += 1
+                self.__countKey(entry[2], 1)
+                entry = self.__place(*entry)
+                if entry: self.__stash(*entry)
+                return
+
+    # Return the sorted list of the stripes of the buckets of the given slots
+    def __stripesOf(self, slots):
+        return sorted({slot // self.__bucketSize % _NUM_STRIPES 
+                       for slot in slots})
+    
+    # Return the first slot of each of the candidate buckets of a key, given
+    # its base hash.
+    def __bucketStarts(self, b):
+        hashFromBase = self.__hashFamily.hashFromBase
+        return [self.__bucketStart(hashFromBase(b, arrNum), arrNum)
+                for arrNum in range(1, self.__numTables+1)]
+    
+    # Hold the locks of the given (sorted) stripes
+    @contextmanager
+    def __locked(self, stripes):
+        locks = self.__locks
+        for s in stripes: locks[s].acquire()
+        try: yield
+        finally:
+            for s in stripes: locks[s].release()
+    
+    # Keep the version numbers of the given stripes odd while their buckets
+    # are changed (with their locks held), so that readers of those stripes
+    # know to look again.
+    @contextmanager
+    def __writing(self, stripes):
+        versions = self.__versions
+        for s in stripes: versions[s] += 1
+        try: yield
+        finally:
+            for s in stripes: versions[s] += 1
+    
+    # Call fn(*args) holding every lock, with the epoch odd so that no reader 
+    # trusts what it reads meanwhile, and return its result.
+    def __exclusive(self, fn, *args):
+        with self.__locked(range(_NUM_STRIPES)):
+            self.__epoch += 1
+            try: return fn(*args)
+            finally: self.__epoch += 1
+    
+    # find, for a thread-safe table, returning default if the key is not 
+    # found. No lock is taken: the version numbers of the stripes of the 
+    # key's buckets, and the epoch, are read before and after looking in the
+    # buckets, and if any was odd or has changed (so that an entry might 
+    # have been moved, or the arrays replaced, while we looked) we look 
+    # again. Readers only wait for writers that are changing one of the 
+    # key's buckets, and never for each other.
+    def __findOptimistic(self, k, default = None):
+        b = self.__hashFamily.baseHash(k)
+        versions = self.__versions
+        while True:
+            epoch = self.__epoch
+            try:
+                stripes = self.__stripesOf(self.__bucketStarts(b))
+                before = [versions[s] for s in stripes]
+                slot = self.__findBaseSlot(k, b)
+                d = self.__data[slot] if slot >= 0 else default
+                
+                if epoch & 1 == 0 and epoch == self.__epoch and \
+                   all(v & 1 == 0 for v in before) and \
+                   before == [versions[s] for s in stripes]: 
+                    return d
+            
+            # The arrays may have been replaced by a resize while we looked
+            except IndexError: pass
+            time.sleep(0)
+    
+    # insert, for a thread-safe table. The key's buckets are locked while we
+    # check that the key is not already there and look for an empty slot. If
+    # there is none, a chain of evictions is searched for without holding 
+    # any lock, and then the buckets along it are locked too, and the chain
+    # is checked to still be valid before its entries are moved. If anything
+    # changed meanwhile, start over. The key is counted before it is stored,
+    # so that a reader that finds it in a bucket also finds it counted in 
+    # the miss summary. If the arrays grew _RESIZE_TRIES times and there is
+    # still no room for the key, RuntimeError is raised.
+    def __insertLocked(self, k, d):
+        b = self.__hashFamily.baseHash(k)
+        grows = 0
+        while True:
+            epoch = self.__epoch
+            starts = self.__bucketStarts(b)
+            stripes = self.__stripesOf(starts)
+            with self.__locked(stripes):
+                if epoch != self.__epoch: continue
+                if self.__findBaseSlot(k, b) >= 0: return False
+                full = self.__numKeys >= self.__maxKeys
+                slot = -1
+                for start in starts:
+                    for slot in range(start, start + self.__bucketSize):
+                        if self.__keys[slot] is _EMPTY: break
+                    else: slot = -1
+                    if slot >= 0: break
+                if not full and slot >= 0:
+                    with self.__countLock: 
+                        self.__numKeys += 1
+                        self.__countKey(b, 1)
+                        self.__logChange("insert", k, d)
+                    with self.__writing(stripes): self.__store(slot, k, d, b)
+                    return True
+            
+            # Look for a chain of evictions (the arrays may be replaced by a
+            # resize while we look)
+            if not full:
+                try: path = self.__findPath(b)
+                except IndexError: continue
+                if path is None: full = True
+            if full:
+                if grows == _RESIZE_TRIES:
+                    raise RuntimeError("could not place a key in %d grows; "
+                                       "too many keys have the same base "
+                                       "hash" % _RESIZE_TRIES)
+                grows += 1
+                self.__growLocked(epoch)
+                continue
+            
+            # Lock the stripes of the chain along with those of the key's 
+            # buckets, and check that nothing changed before moving anything
+            stripes = self.__stripesOf(starts + path)
+            with self.__locked(stripes):
+                if epoch != self.__epoch or self.__findBaseSlot(k, b) >= 0 \
+                   or self.__numKeys >= self.__maxKeys or \
+                   not self.__validPath(path): 
+                    continue
+                with self.__countLock:
+                    self.__numKeys += 1
+                    self.__countKey(b, 1)
+                    if self.__stats is not None: 
+                        self.__countChain(len(path)-1)
+                    self.__logChange("insert", k, d)
+                with self.__writing(stripes): self.__movePath(path, k, d, b)
+                return True                      
+    
+    # Return True if the given chain of slots (found by __findPath) can still
+    # be used: each slot but the last is full, with an entry that has the 
+    # next slot in one of its buckets, and the last slot is empty.
+    def __validPath(self, path):
+        keys, hashes = self.__keys, self.__hashes
+        hashFromBase = self.__hashFamily.hashFromBase
+        arrSlots = self.__numBuckets * self.__bucketSize
+        if keys[path[-1]] is not _EMPTY: return False
+        for src, dest in zip(path, path[1:]):
+            arrNum = dest // arrSlots + 1
+            start = self.__bucketStart(hashFromBase(hashes[src], arrNum), 
+                                       arrNum)
+            if keys[src] is _EMPTY or not start <= dest < start + \
+               self.__bucketSize: 
+                return False
+        return True
+    
+    # Grow a thread-safe table, unless another thread already resized it 
+    # since the given epoch.
+    def __growLocked(self, epoch):
+        def grow():
+            if self.__epoch == epoch + 1: self.__grow()
+        self.__exclusive(grow)
+    
+    # __setitem__, for a thread-safe table. If the key is not found while 
+    # its buckets are locked, it is inserted, unless another thread inserted
+    # it meanwhile, in which case we start over to update it.
+    def __setLocked(self, k, d):
+        b = self.__hashFamily.baseHash(k)
+        while True:
+            epoch = self.__epoch
+            stripes = self.__stripesOf(self.__bucketStarts(b))
+            with self.__locked(stripes):
+                if epoch != self.__epoch: continue
+                slot = self.__findBaseSlot(k, b)
+                if slot >= 0:
+                    with self.__writing(stripes), self.__countLock: 
+                        self.__data[slot] = d
+                        self.__logChange("set", k, d)
+                    return
+            if self.__insertLocked(k, d): return
+    
+    # delete, for a thread-safe table
+    def __deleteLocked(self, k):
+        b = self.__hashFamily.baseHash(k)
+        while True:
+            epoch = self.__epoch
+            stripes = self.__stripesOf(self.__bucketStarts(b))
+            with self.__locked(stripes):
+                if epoch != self.__epoch: continue
+                slot = self.__findBaseSlot(k, b)
+                if slot < 0: return None
+                n = (self.__keys[slot], self.__data[slot])
+                with self.__writing(stripes), self.__countLock:
+                    self.__clear(slot)
+                    self.__logChange("delete", k)
+                break
+        if self.__numKeys < self.__minKeys: self.compact()
+        return n
+    
+    # Hold every lock of a thread-safe table (so that no entry moves) while
+    # reading the whole table, or do nothing for any other table.
+    @contextmanager
+    def __quiet(self):
+        if self.__locks is None: yield
+        else:
+            with self.__locked(range(_NUM_STRIPES)): yield
+
+    # Save the CuckooHash to a snapshot file at path, which MappedCuckooHash
+    # can open and look keys up in right away, without reading or rehashing
+    # anything (see MappedCuckooHash.py for the file format). An incremental
+    # resize in progress is finished first.
+    def save(self, path):
+        with self.__quiet():
+            self.__finishMigration()
+            keys, data, hashes = self.__keys, self.__data, self.__hashes
+            slots = [None if keys[i] is _EMPTY else 
+                     (keys[i], data[i], hashes[i]) for i in range(len(keys))]
+            writeSnapshot(path, self.__hashFamily, self.__keyWidth, 
+                          self.__numTables, self.__bucketSize, 
+                          self.__numBuckets, self.__numSlots, 
+                          self.__numKeys, self.__numStashed, slots)
+
+    # Return a FrozenCuckooHash holding the entries of the table, for a table
+    # that will only be read from now on. The entries are placed again, from
+    # their cached base hashes, into new arrays with buckets of bucketSize 
+    # slots that are just big enough to hold them at the maximum load factor
+    # for that bucket size (with the shortest eviction chains, found 
+    # breadth-first). If they don't fit, the arrays are made 5% bigger and 
+    # new hash functions are drawn, until they do (or RuntimeError is raised
+    # after _RESIZE_TRIES attempts). The table itself is left unchanged.
+    def freeze(self, bucketSize = 4):
+        with self.__quiet():
+            arrays = [(c.__keys, c.__data, c.__hashes) 
+                      for c in self.__generations()]
+            numKeys = len(self)
+            
+            # Place the entries with a table of the same kind (sharing the
+            # same base hash), but with the new bucket size and no stash
+            dense = CuckooHash(1, bucketSize = bucketSize, 
+                               numTables = self.__numTables, 
+                               insertStrategy = "bfs")
+            dense.__hashFamily = self.__hashFamily.spawn()
+            size = dense.__sizeFor(numKeys, 1)
+            for i in range(_RESIZE_TRIES):
+                dense.__allocate(int(size))
+                if all(dense.__placeAll(*a) for a in arrays): break
+                dense.__hashFamily.reset()
+                size *= 1.05
+            else: 
+                raise RuntimeError("could not freeze the table; too many "
+                                   "keys have the same base hash")
         
-        # return the string of the list
-        return str(temp)
+        keys, data, hashes = dense.__keys, dense.__data, dense.__hashes
+        slots = [None if keys[i] is _EMPTY else (keys[i], data[i], hashes[i])
+                 for i in range(len(keys))]
+        return FrozenCuckooHash(dense.__hashFamily, self.__numTables, 
+                                bucketSize, dense.__numBuckets, slots)
+
+    # Return a generator of chunks of bytes that, together, hold everything
+    # needed to rebuild the table exactly as it is (see importChunks), e.g.
+    # to send it to another process without ever having all of it in memory
+    # at once. The first chunk is a header with the layout of the arrays, 
+    # the hash family (with its seeds) and the position of the change log,
+    # and each of the others holds the entries of the next chunkSize slots,
+    # as a pickled list of (slot, key, data, base hash). An incremental 
+    # resize in progress is finished first. Just like while iterating over
+    # it, the table must not be changed while it is exported, except that a
+    # thread-safe table exports a copy of its arrays (of references to the 
+    # keys and data, taken holding every lock), so other threads may keep 
+    # using it.
+    def exportChunks(self, chunkSize = 4096):
+        assert chunkSize > 0
+        with self.__quiet():
+            self.__finishMigration()
+            keys, data, hashes = self.__keys, self.__data, self.__hashes
+            if self.__locks is not None: 
+                keys, data, hashes = list(keys), list(data), array('Q',hashes)
+            header = {"hashFamily": self.__hashFamily, 
+                      "keyWidth": self.__keyWidth, 
+                      "numTables": self.__numTables, 
+                      "bucketSize": self.__bucketSize, 
+                      "numBuckets": self.__numBuckets, 
+                      "stashSize": self.__stashSize, 
+                      "maxLoadFactor": self.__maxLoadFactor, 
+                      "numKeys": self.__numKeys, 
+                      "logPosition": self.logPosition()}
+        yield pickle.dumps(header)
+        for start in range(0, len(keys), chunkSize):
+            yield pickle.dumps([(i, keys[i], data[i], hashes[i]) 
+                                for i in range(start, min(start + chunkSize,
+                                                          len(keys)))
+                                if keys[i] is not _EMPTY])
+    
+    # Return a new CuckooHash rebuilt from the chunks (an iterable of bytes)
+    # made by exportChunks: every entry is put back in the same slot, with 
+    # the same hash functions, so nothing is hashed again. Any other options
+    # are passed on to CuckooHash (the layout and hash family are those of 
+    # the exported table). The new table's change log starts at the position
+    # of the exported table's, so that it can catch up with it by replaying
+    # its later changes (see applyChanges). Raise ValueError if the chunks 
+    # end before all of the entries are rebuilt. The chunks are unpickled, 
+    # so only import chunks from a trusted source.
+    @classmethod
+    def importChunks(cls, chunks, **options):
+        chunks = iter(chunks)
+        header = pickle.loads(next(chunks))
+        c = cls(header["numBuckets"] * header["bucketSize"], 
+                bucketSize = header["bucketSize"], 
+                maxLoadFactor = header["maxLoadFactor"], 
+                numTables = header["numTables"], 
+                stashSize = header["stashSize"], **options)
+        c.__hashFamily = family = header["hashFamily"]
+        c.__keyWidth = header["keyWidth"]
+        c.__vectorized = numpy is not None and \
+                         type(family) in (IntHashFamily, BytesHashFamily)
+        c.__logStart = header["logPosition"]
+        for chunk in chunks:
+            for slot, k, d, b in pickle.loads(chunk):
+                c.__store(slot, k, d, b)
+                c.__countKey(b, 1)
+                c.__numKeys += 1
+                if slot >= c.__numSlots: c.__numStashed += 1
+        if c.__numKeys != header["numKeys"]: 
+            raise ValueError("the chunks of the table are incomplete")
+        return c
+
+    # Append a change to the change log, if the table keeps one
+    def __logChange(self, *change):
+        if self.__log is not None: self.__log.append(change)
+
+    # Return the position of the change log: the number of changes made to
+    # the table (or replayed by it, or made to the table it was imported 
+    # from before it was exported) so far.
+    def logPosition(self): 
+        if self.__log is None: return self.__logStart
+        return self.__logStart + len(self.__log)
     
+    # Return a list of the changes made to the table since the log was at 
+    # the given position (at most limit of them, if limit is given), for a
+    # follower at that position to replay. Raise ValueError if the log was 
+    # trimmed past that position, in which case the follower must import 
+    # the whole table again.
+    def changesSince(self, position, limit = None):
+        assert self.__log is not None
+        with self.__countLock if self.__locks is not None else _NO_LOCK:
+            start = position - self.__logStart
+            if start < 0: 
+                raise ValueError("the change log was trimmed past position "
+                                 "%d" % position)
+            assert start <= len(self.__log)
+            end = None if limit is None else start + limit
+            return self.__log[start:end]
+    
+    # Drop the changes made before the given position from the change log, 
+    # once every follower has replayed them, so that the log doesn't keep
+    # growing.
+    def trimLog(self, position):
+        assert self.__log is not None
+        with self.__countLock if self.__locks is not None else _NO_LOCK:
+            assert self.__logStart <= position <= self.logPosition()
+            del self.__log[:position - self.__logStart]
+            self.__logStart = position
+
+    # Replay a list of changes (returned by changesSince of the table this 
+    # one follows) on the table, and move its change log past them. If the
+    # table keeps a change log, the changes are appended to it as they are,
+    # so that it can be followed in turn. A follower should only be changed
+    # by replaying changes, or it won't be a copy of its leader anymore.
+    def applyChanges(self, changes):
+        log, self.__log = self.__log, None
+        try:
+            for change in changes:
+                op, *args = change
+                if op == "insert": self.insert(*args)
+                elif op == "set": self[args[0]] = args[1]
+                elif op == "delete": self.delete(*args)
+                elif op == "clear": self.clear()
+                else: raise ValueError("unknown change " + repr(op))
+                if log is None: self.__logStart += 1
+                else: log.append(change)
+        finally: self.__log = log
+
+    # Accessor str method for printing the CuckooHash key-data pairs
+    def __str__(self):
+        # create a list of all key-data pairs from all arrays (including the
+        # old arrays during an incremental resize), and return its string
+        with self.__quiet(): return str(list(self.__slotItems()))
+
     # Accessor method that returns the keys in a list
     def getKeys(self):
-        # Create a temporary list
-        temp = []
-        
-        # For each non-None node in both hash arrays, add all keys to temp list
-        for i in range(len(self.__hashArr1)):
-            n = self.__hashArr1[i]
-            if n: temp += [n.key]
-            n = self.__hashArr2[i]
-            if n: temp += [n.key]
-            
-        # Return the list
-        return temp
-    
+        with self.__quiet(): return [k for k, d in self.__slotItems()]
+
     # Accessor method that returns the data in a list
     def getData(self):
-        # Create a temporary list
-        temp = []
-        
-        # For each non-None node in both hash arrays, add all data to temp list
-        for i in range(len(self.__hashArr1)):
-            n = self.__hashArr1[i]
-            if n: temp += [n.data]
-            n = self.__hashArr2[i]
-            if n: temp += [n.data]      
-        
-        # Return the list
-        return temp
-        
+        with self.__quiet(): return [d for k, d in self.__slotItems()]
+    
+    # Return a generator of the (key, data) pairs of every non-empty slot of
+    # all arrays (including the old arrays during an incremental resize)
+    def __slotItems(self):
+        for c in self.__generations():
+            keys, data = c.__keys, c.__data
+            for slot in range(len(keys)):
+                if keys[slot] is not _EMPTY: yield keys[slot], data[slot]
+    
+    # Return an iterator over the (key, data) pairs of the table, for the 
+    # iterators of the table and its views. Lookups made while iterating 
+    # would move entries during an incremental resize, so the resize is 
+    # finished first. Other threads may move the entries of a thread-safe 
+    # table at any time, so its pairs are copied to a list (holding every
+    # lock) instead. Just like a dict, the table must not be changed while
+    # iterating over it.
+    def _iterItems(self):
+        if self.__locks is not None:
+            with self.__quiet(): return iter(list(self.__slotItems()))
+        self.__finishMigration()
+        return self.__slotItems()
+    
+    # Return an iterator over the keys
+    def __iter__(self): return (k for k, d in self._iterItems())
     
+    # Return views of the data and of the (key, data) pairs, which iterate
+    # over the slots directly rather than looking up each key.
+    def values(self): return _ValuesView(self)
+    def items(self): return _ItemsView(self)
+
+class _ValuesView(ValuesView):
+    def __iter__(self): return (d for k, d in self._mapping._iterItems())
+
+class _ItemsView(ItemsView):
+    def __iter__(self): return self._mapping._iterItems()
+
+
 def __main():
     
     # Initialize a small CuckooHash object
@@ -0,0 +1,129 @@
+import pickle
+from array import array
+from collections.abc import Mapping
+from BitHash import BytesHashFamily
+
+_MASK64 = (1 << 64) - 1
+
+# Marks an empty slot, just like in CuckooHash
+_EMPTY = object()
+
+# Return the given blobs of bytes joined into one bytes object, and an
+# array('Q') of offsets into it, so that blob i is between the offsets i
+# and i+1.
+def _pack(blobs):
+    offsets = array('Q', [0])
+    for blob in blobs: offsets.append(offsets[-1] + len(blob))
+    return b"".join(blobs), offsets
+
+# An immutable CuckooHash, made by CuckooHash.freeze, for tables that are
+# built once and then only read.
+#
+# The entries are packed densely into buckets of 4 slots (at up to ~95% load,
+# instead of the ~50% of the default one slot per bucket). Just like in a
+# snapshot file (see MappedCuckooHash), the keys and data are pickled (bytes
+# keys of a BytesHashFamily are kept as they are) into one bytes object each,
+# with an array('Q') of offsets telling where each slot's key or data is,
+# and the cached base hashes are kept in an array('Q'). find does all its
+# work in one method: the seeds of the hash functions are kept in a tuple,
+# each hash value is computed inline with one multiplication, and only the
+# cached base hashes are compared until one matches, without any of the
+# checks a mutable table needs for resizes, the stash or other threads. Only
+# then is the key of that slot unpickled and compared, and its data
+# unpickled. The keys and data must therefore be picklable.
+#
+# Since nothing ever changes, a frozen table can be shared by any number of
+# threads without locks. It is made of a handful of Python objects (none per
+# entry), so after a fork, lookups don't write to the pages holding the
+# table to update reference counts, and the pages stay shared with the
+# parent. (Only the keys and data returned by find are new objects.)
+class FrozenCuckooHash(Mapping):
+
+    # Make a frozen table from the layout of a CuckooHash's arrays: its hash
+    # family, number of hash arrays, bucket size, number of buckets per array
+    # and, for every slot of its arrays (it has no stash), either None for 
+    # an empty slot or the slot's (key, data, base hash).
+    def __init__(self, hashFamily, numTables, bucketSize, numBuckets, slots):
+        self.__hashFamily = hashFamily
+        self.__seeds = tuple(hashFamily.getSeeds()[1:numTables+1])
+        self.__bucketSize = bucketSize
+        self.__numBuckets = numBuckets
+        self.__numSlots = numTables * numBuckets * bucketSize
+
+        # An empty slot has an empty key and data, and a base hash of 0
+        self.__rawKeys = type(hashFamily) is BytesHashFamily
+        keys, data = [], []
+        self.__hashes = array('Q', bytes(8 * len(slots)))
+        for i, entry in enumerate(slots):
+            if entry is None:
+                keys.append(b"")
+                data.append(b"")
+                continue
+            k, d, self.__hashes[i] = entry
+            keys.append(k if self.__rawKeys else pickle.dumps(k))
+            data.append(pickle.dumps(d))
+        self.__keys, self.__keyOffsets = _pack(keys)
+        self.__data, self.__dataOffsets = _pack(data)
+        self.__numKeys = sum(entry is not None for entry in slots)
+
+    # Return how many keys are in the table
+    def __len__(self): return self.__numKeys
+
+    # Return the total number of slots in all hash arrays
+    def capacity(self): return self.__numSlots
+
+    # Return the fraction of slots in use
+    def loadFactor(self): return self.__numKeys / self.__numSlots
+
+    # Given a key, return the data associated with it, or default if the key
+    # is not in the table.
+    def find(self, k, default = None):
+        b = self.__hashFamily.baseHash(k)
+        hashes, keyOffsets = self.__hashes, self.__keyOffsets
+        numBuckets, bucketSize = self.__numBuckets, self.__bucketSize
+        start = 0
+        for seed in self.__seeds:
+            slot = start + (((b * seed) & _MASK64) >> 32) % numBuckets * \
+                           bucketSize
+            for slot in range(slot, slot + bucketSize):
+                if hashes[slot] == b and \
+                   keyOffsets[slot] < keyOffsets[slot+1] and \
+                   self.__key(slot) == k:
+                    offsets = self.__dataOffsets
+                    return pickle.loads(
+                        self.__data[offsets[slot]:offsets[slot+1]])
+            start += numBuckets * bucketSize
+        return default
+    get = find
+
+    # Return the data of key k, or raise KeyError if k is not in the table
+    def __getitem__(self, k):
+        d = self.find(k, _EMPTY)
+        if d is _EMPTY: raise KeyError(k)
+        return d
+
+    # Return True if key k is in the table
+    def __contains__(self, k): return self.find(k, _EMPTY) is not _EMPTY
+
+    # Given an iterable of keys, return a list with the data associated with
+    # each key, or None for the keys that are not in the table.
+    def findMany(self, keys):
+        find = self.find
+        return [find(k) for k in keys]
+
+    # Given an iterable of keys, return a list of bools telling whether each
+    # key is in the table.
+    def containsMany(self, keys):
+        find = self.find
+        return [find(k, _EMPTY) is not _EMPTY for k in keys]
+
+    # Return the key stored in the given (non-empty) slot
+    def __key(self, slot):
+        k = self.__keys[self.__keyOffsets[slot]:self.__keyOffsets[slot+1]]
+        return k if self.__rawKeys else pickle.loads(k)
+
+    # Return an iterator over the keys
+    def __iter__(self): 
+        offsets = self.__keyOffsets
+        return (self.__key(slot) for slot in range(len(self.__hashes))
+                if offsets[slot] < offsets[slot+1])
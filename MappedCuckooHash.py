@@ -0,0 +1,189 @@
+import mmap
+import pickle
+import struct
+from array import array
+from BitHash import BitHashFamily, IntHashFamily, BytesHashFamily, \
+                    XXHashFamily, Blake2bHashFamily
+
+# A read-only CuckooHash that looks keys up directly in a snapshot file saved
+# by CuckooHash.save, which is memory-mapped rather than read, so that opening
+# even a huge snapshot takes constant time: nothing is deserialized or hashed
+# until a key is looked up, and then only the slots of that key's buckets are
+# read (by the OS, from the page cache or the disk).
+#
+# File layout (all numbers are little-endian, and every part starts at a
+# multiple of 8 bytes):
+#   the header (_HEADER): a magic string, the hash family of the table (its
+#       index in _FAMILIES), the key width, the number of hash arrays, the 
+#       bucket size, the number of buckets per array, the number of slots in
+#       the hash arrays, the size of the stash, the number of keys and the 
+#       number of stashed keys
+#   the seeds of the table's hash functions (see BitHashFamily.getSeeds)
+#   the cached base hash of each slot (8 bytes per slot), laid out like the
+#       flat arrays of CuckooHash, with the stash after the hash arrays
+#   the offset in the file of the key of each slot, plus the offset of the
+#       end of the last key (8 bytes each), so that slot i's key is between
+#       the offsets i and i+1, and is empty for an empty slot
+#   the offset of the data of each slot, plus the end, in the same way
+#   the keys: pickled, except that bytes keys are stored as they are
+#   the data, pickled
+#
+# The keys and data are unpickled when they are looked up, so only open
+# snapshot files from a trusted source.
+
+_MAGIC = b"CUCKMMAP"
+_HEADER = struct.Struct("<8s9Q")
+_FAMILIES = [BitHashFamily, IntHashFamily, BytesHashFamily, XXHashFamily, 
+             Blake2bHashFamily]
+
+# Write a snapshot file of a CuckooHash to path, given its hash family and 
+# key width, the layout of its arrays, its numbers of keys and stashed keys,
+# and for every slot of its arrays (and stash), either None for an empty slot
+# or the slot's (key, data, base hash). Only tables hashed by one of 
+# _FAMILIES can be saved, since the snapshot must be hashed the same way.
+def writeSnapshot(path, hashFamily, keyWidth, numTables, bucketSize, 
+                  numBuckets, numSlots, numKeys, numStashed, slots):
+    if type(hashFamily) not in _FAMILIES:
+        raise ValueError("only tables with a built-in hash family can be "
+                         "saved")
+    rawKeys = type(hashFamily) is BytesHashFamily
+    seeds = hashFamily.getSeeds()
+    total = len(slots)
+    hashes = array('Q', [0] * total)
+    keys, data = [], []
+    for i, entry in enumerate(slots):
+        if entry is None:
+            keys.append(b"")
+            data.append(b"")
+            continue
+        k, d, hashes[i] = entry
+        keys.append(k if rawKeys else pickle.dumps(k))
+        data.append(pickle.dumps(d))
+
+    # Compute the offsets of the keys and the data, which come after the
+    # header, the seeds, the base hashes and both arrays of offsets
+    offset = _HEADER.size + 8 * (len(seeds) + total + 2 * (total+1))
+    keyOffsets, dataOffsets = array('Q'), array('Q')
+    for blobs, offsets in ((keys, keyOffsets), (data, dataOffsets)):
+        for blob in blobs:
+            offsets.append(offset)
+            offset += len(blob)
+        offsets.append(offset)
+
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _FAMILIES.index(type(hashFamily)), 
+                             keyWidth, numTables, bucketSize, numBuckets, 
+                             numSlots, total-numSlots, numKeys, numStashed))
+        f.write(array('Q', seeds).tobytes())
+        for a in (hashes, keyOffsets, dataOffsets): f.write(a.tobytes())
+        for blob in keys: f.write(blob)
+        for blob in data: f.write(blob)
+
+class MappedCuckooHash(object):
+
+    # Open the snapshot file at path, which was saved by CuckooHash.save
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.__buf = memoryview(self.__mmap)
+        magic, family, keyWidth, self.__numTables, self.__bucketSize, \
+            self.__numBuckets, self.__numSlots, stashSize, self.__numKeys, \
+            self.__numStashed = _HEADER.unpack_from(self.__buf)
+        if magic != _MAGIC: raise ValueError("not a CuckooHash snapshot")
+
+        # Use the same kind of hash family, with the same seeds, as the
+        # table that was saved
+        family = _FAMILIES[family]
+        self.__rawKeys = family is BytesHashFamily
+        if self.__rawKeys:
+            self.__hashFamily = BytesHashFamily(self.__numTables, keyWidth)
+        else: self.__hashFamily = family(self.__numTables)
+        offset = _HEADER.size
+        seeds = self.__buf[offset:offset + 8*(self.__numTables+1)].cast("Q")
+        self.__hashFamily.setSeeds(list(seeds))
+        seeds.release()
+        offset += 8 * (self.__numTables+1)
+
+        # Views of the arrays of base hashes and offsets
+        total = self.__numSlots + stashSize
+        self.__hashes = self.__buf[offset:offset + 8*total].cast("Q")
+        offset += 8 * total
+        self.__keyOffsets = self.__buf[offset:offset + 8*(total+1)].cast("Q")
+        offset += 8 * (total+1)
+        self.__dataOffsets = self.__buf[offset:offset + 8*(total+1)].cast("Q")
+
+    # Return how many keys are in the table
+    def __len__(self): return self.__numKeys
+
+    # Return the total number of slots in all hash arrays
+    def capacity(self): return self.__numSlots
+
+    # Return the key stored in the given (non-empty) slot
+    def __key(self, slot):
+        k = self.__buf[self.__keyOffsets[slot]:self.__keyOffsets[slot+1]]
+        return bytes(k) if self.__rawKeys else pickle.loads(k)
+
+    # Return the data stored in the given (non-empty) slot
+    def __data(self, slot):
+        start, end = self.__dataOffsets[slot], self.__dataOffsets[slot+1]
+        return pickle.loads(self.__buf[start:end])
+
+    # Return True if the given slot is empty
+    def __isEmpty(self, slot):
+        return self.__keyOffsets[slot] == self.__keyOffsets[slot+1]
+
+    # Given a key, return the slot it occupies, or -1 if it is not in the
+    # table. Just like CuckooHash, the cached base hash of each slot of the
+    # key's buckets is compared first, and then the key itself.
+    def __findSlot(self, k):
+        b = self.__hashFamily.baseHash(k)
+        hashFromBase, hashes = self.__hashFamily.hashFromBase, self.__hashes
+        numBuckets, bucketSize = self.__numBuckets, self.__bucketSize
+        for arrNum in range(1, self.__numTables+1):
+            start = ((arrNum-1) * numBuckets +
+                     hashFromBase(b, arrNum) % numBuckets) * bucketSize
+            for slot in range(start, start + bucketSize):
+                if hashes[slot] == b and not self.__isEmpty(slot) and \
+                   self.__key(slot) == k:
+                    return slot
+
+        # Look in the stash, if any keys were stashed
+        if self.__numStashed:
+            for slot in range(self.__numSlots, len(hashes)):
+                if hashes[slot] == b and not self.__isEmpty(slot) and \
+                   self.__key(slot) == k:
+                    return slot
+        return -1
+
+    # Given a key, return the data associated with it, or None if the key is
+    # not in the table.
+    def find(self, k):
+        slot = self.__findSlot(k)
+        if slot < 0: return None
+        return self.__data(slot)
+
+    # Given an iterable of keys, return a list with the data associated with
+    # each key, or None for the keys that are not in the table.
+    def findMany(self, keys): return [self.find(k) for k in keys]
+
+    # Given an iterable of keys, return a list of bools telling whether each
+    # key is in the table.
+    def containsMany(self, keys):
+        return [self.__findSlot(k) >= 0 for k in keys]
+
+    # Return the keys in a list
+    def getKeys(self):
+        return [self.__key(slot) for slot in range(len(self.__hashes))
+                if not self.__isEmpty(slot)]
+
+    # Return the data in a list
+    def getData(self):
+        return [self.__data(slot) for slot in range(len(self.__hashes))
+                if not self.__isEmpty(slot)]
+
+    # Unmap the file. The table can't be used anymore after that.
+    def close(self):
+        for view in (self.__hashes, self.__keyOffsets, self.__dataOffsets,
+                     self.__buf):
+            view.release()
+        self.__mmap.close()
@@ -0,0 +1,342 @@
+import multiprocessing
+import random
+import struct
+from multiprocessing import shared_memory
+from BitHash import BitHashFamily, IntHashFamily, BytesHashFamily
+from CuckooHash_SG import defaultMaxLoadFactor
+
+# A hash table whose keys are partitioned into numShards independent cuckoo
+# hash tables (shards), each kept in a block of shared memory (see
+# multiprocessing.shared_memory) rather than in Python lists, so that every
+# process on the machine can look keys up in the same table without pickling
+# or copying it. Shared memory only holds bytes, so keys and data are either
+# ints (stored in 8 bytes) or bytes strings of a fixed width.
+#
+# The table is built all at once, with its shards built in parallel by a 
+# pool of processes, and is read-only from then on. Any process can attach to
+# it by name with ShardedCuckooHash(name = name), and pickling a 
+# ShardedCuckooHash (e.g. to pass it to a worker) only pickles its name.
+#
+# Layout: the block called name holds a header (_HEADER) with the number of
+# shards, the layout of their buckets, the types and widths of the keys and
+# data, followed by the seeds of the hash function that picks each key's
+# shard. Shard i is kept in the block called name_i, which holds a header
+# (_SHARD_HEADER) with its number of buckets and keys and the seeds of its
+# hash functions, followed by four arrays with one element per slot: the
+# base hash of the slot's key (8 bytes), whether the slot is in use (1 byte,
+# padded to a multiple of 8 bytes in all), the key, and the data.
+
+_MAGIC = b"CUCKSHRD"
+_HEADER = struct.Struct("<8s7Q")
+_SHARD_HEADER = struct.Struct("<2Q")
+_SEED = struct.Struct("<Q")
+
+# The number of times building a shard is attempted (with new hash functions
+# each time) before giving up.
+_BUILD_TRIES = 20
+
+# Open the existing shared memory block with the given name. Since Python 
+# 3.13, the block is not registered with this process's resource tracker, 
+# which frees the blocks registered with it once every process using it has
+# exited. Before that, it always is, which is harmless in the processes 
+# started by the table's owner (which share its tracker), but means that an
+# unrelated process attaching to the table frees it when it exits.
+def _attach(name):
+    try: return shared_memory.SharedMemory(name, track = False)
+    except TypeError: return shared_memory.SharedMemory(name)
+
+# One cuckoo hash table kept in a buffer, holding keys and data that have
+# already been encoded as bytes of keyWidth and dataWidth bytes.
+class _Shard(object):
+
+    # Return the number of bytes needed for a shard with the given layout
+    @staticmethod
+    def size(numBuckets, numTables, bucketSize, keyWidth, dataWidth):
+        numSlots = numBuckets * numTables * bucketSize
+        return _SHARD_HEADER.size + _SEED.size * (numTables+1) + \
+               numSlots * (8 + keyWidth + dataWidth) + -(-numSlots // 8) * 8
+
+    # Use the shard kept in the given buffer, whose header has already been
+    # written.
+    def __init__(self, buf, numTables, bucketSize, keyWidth, dataWidth):
+        self.__buf = buf
+        self.__numTables, self.__bucketSize = numTables, bucketSize
+        self.__keyWidth, self.__dataWidth = keyWidth, dataWidth
+        self.__numBuckets, self.__numKeys = _SHARD_HEADER.unpack_from(buf)
+
+        offset = _SHARD_HEADER.size
+        self.__hashFamily = BitHashFamily(numTables)
+        self.__hashFamily.setSeeds([_SEED.unpack_from(buf, offset + 8*i)[0]
+                                    for i in range(numTables+1)])
+        offset += _SEED.size * (numTables+1)
+
+        # Views of each array of the buffer
+        numSlots = self.__numBuckets * numTables * bucketSize
+        self.__hashes = buf[offset:offset + 8*numSlots].cast("Q")
+        offset += 8 * numSlots
+        self.__used = buf[offset:offset + numSlots]
+        offset += -(-numSlots // 8) * 8
+        self.__keys = buf[offset:offset + keyWidth*numSlots]
+        offset += keyWidth * numSlots
+        self.__data = buf[offset:offset + dataWidth*numSlots]
+
+    # Release the views of the buffer, which must be done before the shared
+    # memory block holding it is closed.
+    def release(self):
+        for view in (self.__hashes, self.__used, self.__keys, self.__data):
+            view.release()
+
+    def __len__(self): return self.__numKeys
+
+    # Return the first slot of the bucket that the base hash b maps to in the
+    # given array
+    def __bucketStart(self, b, arrNum):
+        numBuckets = self.__numBuckets
+        h = self.__hashFamily.hashFromBase(b, arrNum)
+        return ((arrNum-1) * numBuckets + h % numBuckets) * self.__bucketSize
+
+    # Given an encoded key and its base hash, return the encoded data
+    # associated with it, or None if the key is not in the shard.
+    def find(self, kb, b):
+        used, hashes, keys = self.__used, self.__hashes, self.__keys
+        kw, dw = self.__keyWidth, self.__dataWidth
+        for arrNum in range(1, self.__numTables+1):
+            start = self.__bucketStart(b, arrNum)
+            for slot in range(start, start + self.__bucketSize):
+                if used[slot] and hashes[slot] == b and \
+                   keys[slot*kw:(slot+1)*kw] == kb:
+                    return bytes(self.__data[slot*dw:(slot+1)*dw])
+        return None
+
+    # Store the given base hash, encoded key and encoded data in a slot
+    def __store(self, slot, b, kb, db):
+        kw, dw = self.__keyWidth, self.__dataWidth
+        self.__hashes[slot] = b
+        self.__used[slot] = 1
+        self.__keys[slot*kw:(slot+1)*kw] = kb
+        self.__data[slot*dw:(slot+1)*dw] = db
+
+    # Place an entry in the shard, evicting entries along a random walk if
+    # all of its buckets are full, just like CuckooHash. Return True, or
+    # False if an entry was left without a place.
+    def __place(self, b, kb, db):
+        kw, dw = self.__keyWidth, self.__dataWidth
+        for arrNum in range(1, self.__numTables+1):
+            start = self.__bucketStart(b, arrNum)
+            for slot in range(start, start + self.__bucketSize):
+                if not self.__used[slot]:
+                    self.__store(slot, b, kb, db)
+                    return True
+
+        arrNum = 1
+        for i in range(500):
+            start = self.__bucketStart(b, arrNum)
+            for slot in range(start, start + self.__bucketSize):
+                if not self.__used[slot]:
+                    self.__store(slot, b, kb, db)
+                    return True
+
+            slot = start + random.randrange(self.__bucketSize)
+            evicted = (self.__hashes[slot],
+                       bytes(self.__keys[slot*kw:(slot+1)*kw]),
+                       bytes(self.__data[slot*dw:(slot+1)*dw]))
+            self.__store(slot, b, kb, db)
+            b, kb, db = evicted
+            arrNum = 1 + (arrNum + random.randrange(self.__numTables-1)) \
+                         % self.__numTables
+        return False
+
+    # Place every (encoded key, encoded data, base hash) entry in the empty
+    # shard, with new hash functions, and draw new ones and start over 
+    # whenever an entry can't be placed. Return True, or False if it failed
+    # every time.
+    def build(self, entries):
+        for i in range(_BUILD_TRIES):
+            self.__hashFamily.reset()
+            self.__used[:] = bytes(len(self.__used))
+            if all(self.__place(b, kb, db) for kb, db, b in entries): break
+        else: return False
+
+        # Save the number of keys and the seeds that worked in the header
+        self.__numKeys = len(entries)
+        _SHARD_HEADER.pack_into(self.__buf, 0, self.__numBuckets,
+                                self.__numKeys)
+        for i, seed in enumerate(self.__hashFamily.getSeeds()):
+            _SEED.pack_into(self.__buf, _SHARD_HEADER.size + 8*i, seed)
+        return True
+
+# Build shard i of the sharded table called name from its list of entries,
+# in a worker process of the pool building the table.
+def _buildShard(name, i, entries, layout):
+    block = _attach("%s_%d" % (name, i))
+    shard = _Shard(block.buf, *layout)
+    try:
+        if not shard.build(entries):
+            raise RuntimeError("could not build shard %d" % i)
+    finally:
+        shard.release()
+        block.close()
+
+class ShardedCuckooHash(object):
+
+    # Build a new table holding every key-data pair from the given iterable 
+    # of pairs (or from the given mapping), split into numShards shards that
+    # are built in parallel by a pool of the given number of processes (by
+    # default, one per CPU; with processes=0, the shards are built in this
+    # process). Keys and data of type int are stored in 8 bytes, and those 
+    # of type bytes must be exactly keyWidth and dataWidth bytes long. The 
+    # table is called name (or a new unique name). This object owns the new
+    # table, and should free it with unlink() once no process needs it.
+    # If pairs is None, instead attach to the existing table called name 
+    # (built in this or any other process), and the other options are not 
+    # used.
+    def __init__(self, pairs = None, name = None, numShards = 8, 
+                 processes = None, keyType = int, keyWidth = 8, 
+                 dataType = int, dataWidth = 8, bucketSize = 4, 
+                 numTables = 2):
+        self.__owner = pairs is not None
+        self.__header, self.__blocks, self.__shards = None, [], []
+        if pairs is None:
+            assert name is not None
+            self.__header = _attach(name)
+            self.__open()
+            self.__shards = [_Shard(block.buf, *self.__layout)
+                             for block in self.__blocks]
+            return
+        
+        assert numShards > 0 and bucketSize > 0 and numTables >= 2
+        if keyType not in (int, bytes) or dataType not in (int, bytes):
+            raise ValueError("keyType and dataType must be int or bytes")
+        if keyType is int:  keyWidth = 8
+        if dataType is int: dataWidth = 8
+        
+        # Create the header block, with new seeds for the hash function that
+        # picks each key's shard.
+        family = IntHashFamily(1) if keyType is int else \
+                 BytesHashFamily(1, keyWidth)
+        self.__header = shared_memory.SharedMemory(name, create = True, 
+            size = _HEADER.size + 2*_SEED.size)
+        _HEADER.pack_into(self.__header.buf, 0, _MAGIC, numShards, numTables,
+                          bucketSize, keyType is int, keyWidth, 
+                          dataType is int, dataWidth)
+        for i, seed in enumerate(family.getSeeds()):
+            _SEED.pack_into(self.__header.buf, _HEADER.size + 8*i, seed)
+        self.__open()
+        
+        try: self.__build(pairs, processes)
+        except BaseException:
+            self.unlink()
+            raise
+    
+    # Read the header block, and unless this object is building the table 
+    # (and has yet to create them), attach to the blocks of the shards.
+    def __open(self):
+        header = self.__header
+        self.__name = header.name
+        magic, numShards, numTables, bucketSize, keyIsInt, keyWidth, \
+            dataIsInt, dataWidth = _HEADER.unpack_from(header.buf)
+        if magic != _MAGIC: raise ValueError("not a ShardedCuckooHash")
+        self.__numShards = numShards
+        self.__layout = (numTables, bucketSize, keyWidth, dataWidth)
+        self.__keyIsInt, self.__dataIsInt = keyIsInt, dataIsInt
+        
+        self.__hashFamily = IntHashFamily(1) if keyIsInt else \
+                            BytesHashFamily(1, keyWidth)
+        self.__hashFamily.setSeeds([
+            _SEED.unpack_from(header.buf, _HEADER.size + 8*i)[0]
+            for i in range(2)])
+        
+        self.__shards = []
+        if not self.__owner:
+            self.__blocks = [_attach("%s_%d" % (self.__name, i))
+                             for i in range(numShards)]
+    
+    # Encode each pair and split them by shard (keeping only the last pair 
+    # of each key, just like a dict), then create each shard's block, big 
+    # enough to hold its keys at a little under the usual maximum load 
+    # factor, and build the shards.
+    def __build(self, pairs, processes):
+        if hasattr(pairs, "items"): pairs = pairs.items()
+        shardPairs = [{} for i in range(self.__numShards)]
+        for k, d in pairs:
+            kb, b, i = self.__locate(k)
+            shardPairs[i][kb] = (kb, self.__encodeData(d), b)
+        entries = [list(p.values()) for p in shardPairs]
+        
+        numTables, bucketSize = self.__layout[:2]
+        maxLoad = 0.9 * defaultMaxLoadFactor(bucketSize, numTables)
+        for i in range(self.__numShards):
+            numBuckets = int(len(entries[i]) / maxLoad / 
+                             (numTables * bucketSize)) + 1
+            block = shared_memory.SharedMemory(
+                "%s_%d" % (self.__name, i), create = True, 
+                size = _Shard.size(numBuckets, *self.__layout))
+            self.__blocks.append(block)
+            _SHARD_HEADER.pack_into(block.buf, 0, numBuckets, 0)
+        
+        args = [(self.__name, i, entries[i], self.__layout) 
+                for i in range(self.__numShards)]
+        if processes == 0:
+            for a in args: _buildShard(*a)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                pool.starmap(_buildShard, args)
+        self.__shards = [_Shard(block.buf, *self.__layout) 
+                         for block in self.__blocks]
+    
+    # Pickling a ShardedCuckooHash only pickles its name, and unpickling it
+    # attaches to the table again.
+    def __reduce__(self): return (ShardedCuckooHash, (None, self.__name))
+    
+    # Return the name of the table, which other processes can attach to
+    def name(self): return self.__name
+    
+    # Return how many keys are in the table
+    def __len__(self): return sum(len(shard) for shard in self.__shards)
+    
+    # Given a key, return it encoded as bytes, its base hash and the number
+    # of its shard. Raise ValueError for an int key that doesn't fit in 8 
+    # bytes (as a signed int), rather than let it stand for another key.
+    def __locate(self, k):
+        if self.__keyIsInt and not -2**63 <= k < 2**63:
+            raise ValueError("int keys must fit in 64 bits")
+        b = self.__hashFamily.baseHash(k)
+        if self.__keyIsInt: k = b.to_bytes(8, "little")
+        return k, b, self.__hashFamily.hashFromBase(b) % self.__numShards
+    
+    # Return the given data encoded as bytes
+    def __encodeData(self, d):
+        if self.__dataIsInt: return d.to_bytes(8, "little", signed = True)
+        if len(d) != self.__layout[3]:
+            raise ValueError("data must be %d bytes long" % self.__layout[3])
+        return bytes(d)
+    
+    # Given a key, return the data associated with it, or None if the key is
+    # not in the table.
+    def find(self, k):
+        kb, b, i = self.__locate(k)
+        d = self.__shards[i].find(kb, b)
+        if d is None or not self.__dataIsInt: return d
+        return int.from_bytes(d, "little", signed = True)
+    
+    # Given an iterable of keys, return a list with the data associated with
+    # each key, or None for the keys that are not in the table.
+    def findMany(self, keys): return [self.find(k) for k in keys]
+    
+    # Stop using the table in this process. (The views of the shards must be
+    # released before their blocks can be closed, which is also done when 
+    # the object is garbage collected.)
+    def close(self):
+        for shard in self.__shards: shard.release()
+        for block in self.__blocks: block.close()
+        if self.__header is not None: self.__header.close()
+        self.__shards = []
+    
+    def __del__(self): self.close()
+    
+    # Close the table, and if this object owns it, free it
+    def unlink(self):
+        self.close()
+        if not self.__owner or self.__header is None: return
+        for block in self.__blocks + [self.__header]: block.unlink()
+        self.__blocks, self.__header = [], None
@@ -0,0 +1,442 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from BitHash import BitHash, HASH_BACKENDS
+from CuckooHash_SG import CuckooHash
+from AsyncCuckooHash import AsyncCuckooHash
+from MappedCuckooHash import MappedCuckooHash
+
+# Benchmarks for the CuckooHash. Run this file to print the results of the 
+# benchmark suite, and pass --output to also save them as JSON, or --compare
+# to print how they changed since an earlier saved run. Pass --extras to also
+# run the rehash, stash, insertion strategy, snapshot, miss summary, event
+# loop latency, hash backend, frozen table and cache reports.
+
+# Fill a CuckooHash of the given size with the keys made by makeKey from 0, 1,
+# 2, ... until an insert makes it grow. Return how many keys that insert had
+# to rehash, and how many seconds it took.
+def timeGrow(size, makeKey = str, **options):
+    c = CuckooHash(size, **options)
+    i = 0
+    while True:
+        capacity, numKeys = c.capacity(), len(c)
+        start = time.perf_counter()
+        c.insert(makeKey(i), i)
+        elapsed = time.perf_counter() - start
+        if c.capacity() != capacity: return numKeys, elapsed
+        i += 1
+
+# Return how many seconds it takes to hash numKeys keys once each with
+# BitHash, which is the least a rehash had to pay for when every key was
+# hashed again from scratch.
+def timeBitHash(numKeys, makeKey = str):
+    keys = [makeKey(i) for i in range(numKeys)]
+    start = time.perf_counter()
+    for k in keys: BitHash(k, 1)
+    return time.perf_counter() - start
+
+# Report the cost of the rehash done by a grow, per rehashed key, next to the
+# cost of hashing each of those keys just once with BitHash.
+def benchRehash(sizes = (1000, 10000, 100000, 1000000)):
+    print("Rehash cost of a grow")
+    print("%10s %12s %12s %16s" % ("keys", "grow (ms)", "us per key",
+                                   "BitHash us/key"))
+    for size in sizes:
+        numKeys, elapsed = timeGrow(size)
+        hashing = timeBitHash(numKeys)
+        print("%10d %12.1f %12.3f %16.3f" % (numKeys, elapsed*1000,
+                                             elapsed/numKeys*1e6,
+                                             hashing/numKeys*1e6))
+
+# Insert numKeys keys into a CuckooHash of the given size, and return how many
+# times it grew, and its load factor at the end.
+def countGrows(size, numKeys, **options):
+    c = CuckooHash(size, **options)
+    grows = 0
+    for i in range(numKeys):
+        capacity = c.capacity()
+        c.insert(str(i), i)
+        if c.capacity() != capacity: grows += 1
+    return grows, c.loadFactor()
+
+# Report how many grows a small stash saves when the table is filled close to
+# its maximum load factor, where insertions fail most often.
+def benchStash(numKeys = 100000, stashSizes = (0, 1, 2, 4, 8), 
+               maxLoadFactor = 0.49):
+    print("Grows while inserting %d keys" % numKeys)
+    print("%10s %8s %8s" % ("stashSize", "grows", "load"))
+    for stashSize in stashSizes:
+        grows, load = countGrows(numKeys // 2, numKeys, stashSize = stashSize,
+                                 maxLoadFactor = maxLoadFactor)
+        print("%10d %8d %8.3f" % (stashSize, grows, load))
+
+# Fill a CuckooHash with no maximum load factor until it first grows, and
+# return the load factor it reached and the average seconds per insert.
+def fillUntilGrow(size, **options):
+    c = CuckooHash(size, maxLoadFactor = 1, **options)
+    capacity = c.capacity()
+    i = 0
+    start = time.perf_counter()
+    while c.capacity() == capacity:
+        c.insert(str(i), i)
+        i += 1
+    elapsed = time.perf_counter() - start
+    return (i-1) / capacity, elapsed / i
+
+# Compare the random-walk and breadth-first insertion strategies by the load 
+# each reaches before the first grow, and the cost per insert on the way.
+def benchInsertStrategy(size = 10000):
+    print("Load reached before the first grow")
+    print("%8s %8s %8s %10s %10s" % ("buckets", "arrays", "strategy", "load",
+                                     "us/insert"))
+    for bucketSize, numTables in ((1, 2), (1, 3), (2, 2), (4, 2)):
+        for strategy in ("random", "bfs"):
+            load, elapsed = fillUntilGrow(size, bucketSize = bucketSize,
+                                          numTables = numTables,
+                                          insertStrategy = strategy)
+            print("%8d %8d %8s %10.3f %10.2f" % (bucketSize, numTables,
+                                                 strategy, load, 
+                                                 elapsed*1e6))
+
+# Return the p-th percentile (0 <= p <= 100) of a sorted list of values
+def percentile(values, p):
+    if not values: return 0
+    return values[min(len(values)-1, int(len(values) * p / 100))]
+
+# Given the latencies in nanoseconds of each operation of a workload, and the 
+# number of times the table grew during it, return a dict of its results.
+def summarize(latencies, grows):
+    latencies.sort()
+    total = sum(latencies)
+    return {"ops": len(latencies),
+            "opsPerSec": len(latencies) / (total / 1e9) if total else 0,
+            "p50us": percentile(latencies, 50) / 1000,
+            "p99us": percentile(latencies, 99) / 1000,
+            "p999us": percentile(latencies, 99.9) / 1000,
+            "grows": grows}
+
+# Call the given CuckooHash method once for each of the given argument tuples,
+# timing each call, and return the results of the workload.
+def timeOps(c, method, args):
+    latencies = []
+    grows = 0
+    clock = time.perf_counter_ns
+    for a in args:
+        capacity = c.capacity()
+        start = clock()
+        method(*a)
+        latencies.append(clock() - start)
+        if c.capacity() != capacity: grows += 1
+    return summarize(latencies, grows)
+
+# Return how many bytes the table for numKeys keys takes, per key, not 
+# counting the keys and data themselves (which exist before tracing starts).
+def bytesPerKey(keys, size, **options):
+    tracemalloc.start()
+    c = CuckooHash(size, **options)
+    for k in keys: c.insert(k, k)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used / len(keys)
+
+# Run every workload on a table sized so that numKeys keys fill it to the 
+# given load factor, and return a dict of results per workload:
+#   insert     insert numKeys new keys
+#   findHit    find each of those keys
+#   findMiss   find numKeys keys that are not in the table
+#   delete     delete each key
+#   mixed      50% finds, 25% inserts and 25% deletes on a half full table
+#   insertMany insert all numKeys keys at once (one latency for the batch)
+def runWorkloads(numKeys, loadFactor, seed = 0, **options):
+    rnd = random.Random(seed)
+    random.seed(seed)
+    numTables = options.get("numTables", 2)
+    size = max(1, int(numKeys / loadFactor / numTables))
+    keys = [str(i) for i in range(numKeys)]
+    missing = [str(-1-i) for i in range(numKeys)]
+    rnd.shuffle(keys)
+    results = {}
+    
+    c = CuckooHash(size, **options)
+    results["insert"] = timeOps(c, c.insert, [(k, k) for k in keys])
+    results["findHit"] = timeOps(c, c.find, [(k,) for k in keys])
+    results["findMiss"] = timeOps(c, c.find, [(k,) for k in missing])
+    results["delete"] = timeOps(c, c.delete, [(k,) for k in keys])
+    
+    c = CuckooHash(size, **options)
+    half = numKeys // 2
+    for k in keys[:half]: c.insert(k, k)
+    ops = []
+    present, absent = keys[:half], keys[half:] + missing
+    for i in range(numKeys):
+        r = rnd.random()
+        if r < 0.5: ops.append((c.find, (rnd.choice(present),)))
+        elif r < 0.75: 
+            k = absent.pop()
+            present.append(k)
+            ops.append((c.insert, (k, k)))
+        else: 
+            k = present.pop(rnd.randrange(len(present)))
+            ops.append((c.delete, (k,)))
+    results["mixed"] = timeOps(c, lambda op, a: op(*a), ops)
+    
+    c = CuckooHash(size, **options)
+    start = time.perf_counter_ns()
+    c.insertMany([(k, k) for k in keys])
+    elapsed = time.perf_counter_ns() - start
+    results["insertMany"] = summarize([elapsed], 0)
+    results["insertMany"]["opsPerSec"] = numKeys / (elapsed / 1e9)
+    
+    results["bytesPerKey"] = bytesPerKey(keys, size, **options)
+    return results
+
+# The table configurations benchmarked by default, as CuckooHash options
+CONFIGS = {"b1d2": {}, 
+           "b4d2": {"bucketSize": 4}, 
+           "b1d3": {"numTables": 3}}
+
+# Run the workloads for every configuration, number of keys and load factor,
+# print a table of the results, and return them all as a JSON-ready dict.
+def benchSuite(sizes = (10000, 100000), loadFactors = (0.25, 0.45), 
+               configs = CONFIGS, seed = 0):
+    runs = []
+    print("%-6s %8s %5s %-10s %12s %9s %9s %9s %6s %8s" % (
+        "config", "keys", "load", "workload", "ops/sec", "p50 us", "p99 us",
+        "p999 us", "grows", "B/key"))
+    for name, options in configs.items():
+        for numKeys in sizes:
+            for loadFactor in loadFactors:
+                results = runWorkloads(numKeys, loadFactor, seed, **options)
+                runs.append({"config": name, "options": options,
+                             "keys": numKeys, "loadFactor": loadFactor,
+                             "results": results})
+                for workload, r in results.items():
+                    if workload == "bytesPerKey": continue
+                    print("%-6s %8d %5.2f %-10s %12.0f %9.2f %9.2f %9.2f "
+                          "%6d %8.1f" % (name, numKeys, loadFactor, workload,
+                                         r["opsPerSec"], r["p50us"], 
+                                         r["p99us"], r["p999us"], r["grows"],
+                                         results["bytesPerKey"]))
+    return {"commit": gitCommit(), "python": sys.version, 
+            "platform": platform.platform(), "time": time.time(), 
+            "seed": seed, "runs": runs}
+
+# Return the hash of the current git commit, or None if it is not known
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], 
+                                       stderr = subprocess.DEVNULL,
+                                       text = True).strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+# Print the ratio of the ops/sec and p99 latency of every workload in the 
+# current results to those in an earlier saved run, where both exist.
+def compare(old, new):
+    print("Compared with commit %s" % old.get("commit"))
+    print("%-6s %8s %5s %-10s %12s %10s" % ("config", "keys", "load", 
+                                           "workload", "ops/sec x", "p99 x"))
+    before = {(r["config"], r["keys"], r["loadFactor"]): r["results"] 
+              for r in old["runs"]}
+    for run in new["runs"]:
+        key = (run["config"], run["keys"], run["loadFactor"])
+        if key not in before: continue
+        for workload, r in run["results"].items():
+            o = before[key].get(workload)
+            if workload == "bytesPerKey" or not o: continue
+            print("%-6s %8d %5.2f %-10s %12.2f %10.2f" % (
+                key + (workload, r["opsPerSec"] / o["opsPerSec"], 
+                       r["p99us"] / o["p99us"] if o["p99us"] else 0)))
+
+# Compare the cold start of a table of numKeys keys: rebuilding it by 
+# inserting every key again, or opening a snapshot of it with 
+# MappedCuckooHash and looking up one key. The snapshot is saved in a 
+# temporary directory, which is removed afterwards.
+def benchSnapshot(numKeys = 1000000):
+    c = CuckooHash(1000, keyType = int)
+    start = time.perf_counter()
+    for i in range(numKeys): c.insert(i, i)
+    rebuild = time.perf_counter() - start
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cuckoo.snapshot")
+        start = time.perf_counter()
+        c.save(path)
+        save = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        m = MappedCuckooHash(path)
+        m.find(numKeys // 2)
+        load = time.perf_counter() - start
+        m.close()
+    
+    print("Cold start with %d keys" % numKeys)
+    print("%-24s %10.3f s" % ("rebuild by inserting", rebuild))
+    print("%-24s %10.3f s" % ("save a snapshot", save))
+    print("%-24s %10.6f s" % ("open snapshot + 1 find", load))
+
+# Compare lookups in tables of numKeys keys with and without a miss summary,
+# for workloads where the given fractions of the keys looked up are missing.
+def benchMissSummary(numKeys = 100000, missRates = (0.5, 0.9, 1.0), 
+                     numLookups = 200000, keyType = int):
+    print("Lookups with and without a miss summary (%d keys)" % numKeys)
+    print("%-12s %12s %12s" % ("miss rate", "plain (s)", "summary (s)"))
+    tables = [CuckooHash(1000, keyType = keyType, missSummary = summary)
+              for summary in (False, True)]
+    for c in tables:
+        for i in range(numKeys): c.insert(i, i)
+    for missRate in missRates:
+        keys = [random.randrange(numKeys, 2*numKeys) 
+                if random.random() < missRate else random.randrange(numKeys)
+                for i in range(numLookups)]
+        times = []
+        for c in tables:
+            start = time.perf_counter()
+            for k in keys: c.find(k)
+            times.append(time.perf_counter() - start)
+        print("%-12.2f %12.3f %12.3f" % (missRate, times[0], times[1]))
+
+# Compare the longest time the event loop is blocked while numKeys keys are
+# inserted into a CuckooHash all at once, or into an AsyncCuckooHash, which
+# yields to the event loop between chunks and while it grows.
+def benchAsyncLatency(numKeys = 1000000, chunkSize = 1000):
+    async def longestStall(insert):
+        stalls = [0]
+        async def tick():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0)
+                stalls[0] = max(stalls[0], time.perf_counter() - start)
+        ticker = asyncio.get_running_loop().create_task(tick())
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await insert()
+        total = time.perf_counter() - start
+        await asyncio.sleep(0)
+        ticker.cancel()
+        return total, stalls[0]
+    
+    async def plain():
+        c = CuckooHash(1000)
+        c.insertMany((str(i), i) for i in range(numKeys))
+    async def chunked():
+        c = AsyncCuckooHash(1000, chunkSize)
+        await c.insertMany((str(i), i) for i in range(numKeys))
+        await c.resized()
+    
+    print("Event loop stalls while inserting %d keys" % numKeys)
+    print("%-16s %12s %16s" % ("table", "total (s)", "longest stall (s)"))
+    for name, insert in (("CuckooHash", plain), ("AsyncCuckooHash", chunked)):
+        print("%-16s %12.3f %16.4f" % ((name,) + 
+                                       asyncio.run(longestStall(insert))))
+
+# For each hash backend and each kind of key it can hash, print how many 
+# million base hashes it computes per second, and how many placements failed
+# and how many times the arrays were rehashed while inserting numKeys keys 
+# into a CuckooHash with one slot per bucket (where weak hashing shows most).
+def benchHashBackends(numKeys = 100000):
+    kinds = {"str": [str(i) for i in range(numKeys)], 
+             "int": list(range(numKeys)),
+             "bytes": [i.to_bytes(8, "little") for i in range(numKeys)],
+             "tuple": [(i, i) for i in range(numKeys)]}
+    print("Hash backends (%d keys)" % numKeys)
+    print("%-14s %-6s %12s %10s %9s" % ("backend", "keys", "Mhashes/s", 
+                                       "failures", "rehashes"))
+    for backend, family in HASH_BACKENDS.items():
+        try: baseHash = family().baseHash
+        except ImportError:
+            print("%-14s (not installed)" % backend)
+            continue
+        for kind, keys in kinds.items():
+            if backend == "multiplyShift" and kind != "int": continue
+            start = time.perf_counter()
+            for k in keys: baseHash(k)
+            rate = numKeys / (time.perf_counter() - start) / 1e6
+            
+            c = CuckooHash(1000, hashBackend = backend, collectStats = True)
+            for k in keys: c.insert(k, None)
+            stats = c.stats()
+            print("%-14s %-6s %12.2f %10d %9d" % (backend, kind, rate,
+                  stats["failedPlacements"], stats["rehashes"]))
+
+# Compare a table of numKeys keys with the frozen table made from it: the 
+# time taken to find every key and as many missing keys, and the bytes per
+# key each one takes (not counting the key and data objects, which the 
+# frozen table keeps pickled copies of instead of references to).
+def benchFreeze(numKeys = 100000):
+    keys = [str(i) for i in range(numKeys)]
+    missing = [str(-i) for i in range(1, numKeys+1)]
+    tracemalloc.start()
+    c = CuckooHash(1000)
+    for k in keys: c.insert(k, k)
+    tableBytes = tracemalloc.get_traced_memory()[0]
+    f = c.freeze()
+    frozenBytes = tracemalloc.get_traced_memory()[0] - tableBytes
+    tracemalloc.stop()
+    
+    print("Frozen table (%d keys)" % numKeys)
+    print("%-18s %10s %10s %14s" % ("table", "hits (s)", "misses (s)", 
+                                    "bytes per key"))
+    for name, t, used in (("CuckooHash", c, tableBytes), 
+                          ("FrozenCuckooHash", f, frozenBytes)):
+        times = []
+        for lookups in (keys, missing):
+            start = time.perf_counter()
+            for k in lookups: t.find(k)
+            times.append(time.perf_counter() - start)
+        print("%-18s %10.3f %10.3f %14.1f" % (name, times[0], times[1],
+                                              used / numKeys))
+
+# Look up numLookups keys drawn from a skewed distribution (key i is drawn
+# about twice as often as key 2*i) in caches with room for about 1%, 5% and
+# 20% of the numKeys distinct keys, inserting each key that misses, and print
+# the hit rates and the number of lookups per second.
+def benchCache(numKeys = 100000, numLookups = 200000):
+    rng = random.Random(0)
+    lookups = [int(numKeys ** rng.random()) for i in range(numLookups)]
+    print("Cache (%d lookups of %d keys)" % (numLookups, numKeys))
+    print("%10s %10s %14s" % ("capacity", "hit rate", "lookups/s"))
+    for fraction in (0.01, 0.05, 0.2):
+        c = CuckooHash(int(numKeys * fraction), bucketSize = 4, cache = True)
+        start = time.perf_counter()
+        for k in lookups:
+            if c.find(k) is None: c.insert(k, k)
+        elapsed = time.perf_counter() - start
+        print("%10d %10.3f %14.0f" % (c.capacity(), c.stats()["hits"] / 
+                                      numLookups, numLookups / elapsed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the CuckooHash")
+    parser.add_argument("--sizes", type = int, nargs = "+", 
+                        default = [10000, 100000])
+    parser.add_argument("--loads", type = float, nargs = "+", 
+                        default = [0.25, 0.45])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "save the results to this file")
+    parser.add_argument("--compare", help = "earlier results to compare to")
+    parser.add_argument("--extras", action = "store_true",
+                        help = "also run the other reports")
+    args = parser.parse_args()
+    
+    results = benchSuite(args.sizes, args.loads, seed = args.seed)
+    if args.output:
+        with open(args.output, "w") as f: json.dump(results, f, indent = 1)
+    if args.compare:
+        with open(args.compare) as f: compare(json.load(f), results)
+    if args.extras:
+        benchRehash()
+        benchStash()
+        benchInsertStrategy()
+        benchSnapshot()
+        benchMissSummary()
+        benchAsyncLatency()
+        benchHashBackends()
+        benchFreeze()
+        benchCache()
@@ -1,10 +1,17 @@
+import asyncio
 import pytest
-from CuckooHash_SG import CuckooHash
+from CuckooHash_SG import CuckooHash, defaultMaxLoadFactor
+from ShardedCuckooHash import ShardedCuckooHash
+from MappedCuckooHash import MappedCuckooHash
+from CuckooFilter import CuckooFilter
+from AsyncCuckooHash import AsyncCuckooHash
+from BitHash import BitHashFamily, HASH_BACKENDS, xxhash
 from random import*
 
 # Initialize a CuckooHash object of a given size with a given number of keys.
-def makeCuckooHash(size, numKeys):
-    c = CuckooHash(size)
+# Any other options are passed on to the CuckooHash constructor.
+def makeCuckooHash(size, numKeys, **options):
+    c = CuckooHash(size, **options)
     for i in range(numKeys):
         c.insert(str(i), i)  # String i is the key and int i is the data
     return c
@@ -133,12 +140,12 @@ def test_find_false_large():
 # Test the insert methof works correctly by asserting the length of the 
 # CuckooHash matches the number of keys inserted, find returns the right
 # data, and finding keys not in the CuckooHash returns None
-def insert_test(size, numKeys = -1):
+def insert_test(size, numKeys = -1, **options):
     # Unless otherwise specified, number of keys to insert are a third of size
     if numKeys == -1: numKeys = size//3
     
     # Make a CuckooHash object of the given size with the given number of keys
-    c = makeCuckooHash(size, numKeys)
+    c = makeCuckooHash(size, numKeys, **options)
     
     # Make sure the correct amount of keys were inserted
     assert len(c) == numKeys
@@ -220,10 +227,10 @@ def test_delete_one():
         assert c.find(str(i)) == i
 
 # Test that delete works when deleting all keys.
-def delete_all(size):
+def delete_all(size, **options):
     # Make a CuckooHash with half of size keys
     numKeys = size//2
-    c = makeCuckooHash(size, numKeys)
+    c = makeCuckooHash(size, numKeys, **options)
     
     # Delete each node and assert that the proper key-data tuple are returned
     # upon deletion
@@ -295,6 +302,873 @@ def test_delete_false_large():
     delete_false(randint(1000, 2000))
     delete_false(randint(3000, 4000))
     delete_false(randint(5000, 8000))
+
+# Test that growing one CuckooHash does not rehash any other live CuckooHash, 
+# since each table owns its own hash functions.
+def test_grow_independent_tables():
+    # Make two tables, one of which has plenty of room
+    numKeys = 500
+    c1 = makeCuckooHash(numKeys*4, numKeys)
+    c2 = makeCuckooHash(10, numKeys)
+    
+    # Force the second table to grow many more times
+    for i in range(numKeys, numKeys*20):
+        c2.insert(str(i), i)
+        
+    # Assert that every key can still be found in the first table
+    for i in range(numKeys):
+        assert c1.find(str(i)) == i
+
+# Test that keys whose data is falsy (or None) are still found by insert, so
+# they are never stored twice, and that None can be used as a key.
+def test_insert_falsy_data():
+    c = CuckooHash(10)
+    assert c.insert("zero", 0)
+    assert c.insert(None, "none")
+    assert not c.insert("zero", 1)
+    assert not c.insert(None, "other")
+    assert len(c) == 2
+    assert c.find("zero") == 0
+    assert c.find(None) == "none"
+    assert c.delete(None) == (None, "none")
+    assert c.find(None) == None
+
+# Test insert on bucketized CuckooHashes, with and without forcing them to grow
+def test_insert_buckets():
+    for bucketSize in (2, 4, 8):
+        insert_test(randint(100, 200), bucketSize = bucketSize)
+        insert_test(randint(10, 80), randint(1000, 2000), bucketSize = bucketSize)
+        insert_test(randint(10, 80), randint(10000, 20000), bucketSize = bucketSize)
+
+# Test that a bucketized CuckooHash fills up to its (high) maximum load factor
+# before it grows.
+def test_buckets_high_load():
+    size, numKeys = 10000, 9000
+    c = makeCuckooHash(size, numKeys, bucketSize = 4)
+    
+    # All the keys fit without growing, at a load of 90%
+    assert c.capacity() == size*2
+    assert c.loadFactor() == numKeys / (size*2)
+    
+    # Keep inserting until the table grows, and check it was almost full first
+    i = numKeys
+    while c.capacity() == size*2:
+        c.insert(str(i), i)
+        i += 1
+    assert i > size*2 * 0.9
+    
+    # delete all keys from a bucketized table
+    for i in range(i):
+        assert c.delete(str(i)) == (str(i), i)
+    assert len(c) == 0
+
+# Test insert on CuckooHashes with more than two hash arrays, with and without
+# buckets, and with and without forcing them to grow
+def test_insert_d_ary():
+    for numTables in (3, 4, 5):
+        insert_test(randint(100, 200), numTables = numTables)
+        insert_test(randint(10, 80), randint(1000, 2000), numTables = numTables)
+        insert_test(randint(10, 80), randint(10000, 20000), 
+                    numTables = numTables, bucketSize = 2)
+        delete_all(randint(300, 500), numTables = numTables)
+
+# Test that a CuckooHash with 4 hash arrays fills up to a high load factor 
+# before it grows, even with one slot per bucket.
+def test_d_ary_high_load():
+    size = 2500
+    c = CuckooHash(size, numTables = 4)
+    i = 0
+    while c.capacity() == size*4:
+        c.insert(str(i), i)
+        i += 1
+    assert i > size*4 * 0.85
+
+# Test that insertMany inserts every pair (skipping keys that are already in
+# the CuckooHash), growing the arrays only once, and that findMany and 
+# containsMany agree with find.
+def test_insert_many():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}):
+        c = makeCuckooHash(10, 5, **options)
+        numKeys = randint(1000, 5000)
+        
+        # Keys 0 to 4 are already there, so only the others are counted
+        assert c.insertMany((str(i), i) for i in range(numKeys)) == numKeys-5
+        assert len(c) == numKeys
+        assert c.loadFactor() > 0.25
+        
+        # Inserting from a dict works as well
+        assert c.insertMany({str(numKeys): numKeys}) == 1
+        
+        keys = [str(i) for i in range(numKeys*2)]
+        data = [i if i <= numKeys else None for i in range(numKeys*2)]
+        assert c.findMany(keys) == data
+        assert c.containsMany(keys) == [d != None for d in data]
+
+# Test a CuckooHash of int keys, and that the bulk operations (which hash 
+# whole arrays of keys at once when NumPy is installed) agree with find.
+def test_int_keys():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}):
+        c = CuckooHash(10, keyType = int, **options)
+        numKeys = randint(1000, 5000)
+        keys = [randint(-2**63, 2**64-1) for i in range(numKeys)] + [0, 1, -1]
+        keys = list(set(keys))
+        assert c.insertMany((k, i) for i, k in enumerate(keys)) == len(keys)
+        assert not c.insert(keys[0], 0)
+        assert len(c) == len(keys)
+        
+        for i, k in enumerate(keys): assert c.find(k) == i
+        others = [k+1 for k in keys if k+1 not in set(keys)]
+        assert c.findMany(keys + others) == \
+               list(range(len(keys))) + [None] * len(others)
+        assert c.containsMany(others) == [False] * len(others)
+        
+        for k in keys[:100]: assert c.delete(k)
+        assert c.containsMany(keys[:200]) == [False]*100 + [True]*100
+
+# Int keys must fit in 64 bits, since ints that only differ in their higher 
+# bits would always collide
+def test_int_keys_range():
+    c = CuckooHash(4, keyType = int)
+    for k in (2**64, 5 + 2**64, 5 + 2**128, -2**63 - 1):
+        with pytest.raises(ValueError): c.insert(k, 0)
+        with pytest.raises(ValueError): c.find(k)
+    assert c.insert(5, 0) and c.insert(2**64 - 1, 1) and c.insert(-2**63, 2)
+    with pytest.raises(ValueError): c.findMany([5, 5 + 2**64])
+    assert len(c) == 3 and c.findMany([5, -2**63]) == [0, 2]
+
+# Test a CuckooHash of fixed-width bytes keys, including bytes keys whose
+# width is not a whole number of 8-byte words.
+def test_bytes_keys():
+    for keyWidth in (4, 8, 13):
+        c = CuckooHash(10, keyType = bytes, keyWidth = keyWidth)
+        keys = list(set(bytes(randint(0, 255) for j in range(keyWidth)) 
+                        for i in range(2000)))
+        assert c.insertMany((k, i) for i, k in enumerate(keys)) == len(keys)
+        assert c.findMany(keys) == list(range(len(keys)))
+        assert c.find(keys[0]) == 0
+        
+        # keys of the wrong width are rejected
+        with pytest.raises(ValueError): c.insert(bytes(keyWidth+1), 0)
+        with pytest.raises(ValueError): c.findMany([bytes(keyWidth-1)])
+
+# Test that the NumPy hash functions compute the same hash values as the 
+# ones that hash one key at a time.
+def test_hash_array():
+    numpy = pytest.importorskip("numpy")
+    from BitHash import IntHashFamily, BytesHashFamily
+    f = IntHashFamily(3)
+    keys = [0, 1, -1, 2**63, 2**64-1, -2**63] + [randint(0, 2**64-1) 
+                                                for i in range(100)]
+    for i in (1, 2, 3):
+        assert f.hashArray(keys, i).tolist() == [f.hash(k, i) for k in keys]
+        assert f.hashArray(numpy.arange(-50, 50), i).tolist() == \
+               [f.hash(k, i) for k in range(-50, 50)]
+    
+    f = BytesHashFamily(2, 11)
+    keys = [bytes(randint(0, 255) for j in range(11)) for i in range(100)]
+    assert f.hashArray(keys, 2).tolist() == [f.hash(k, 2) for k in keys]
+
+# A key that counts how many times it has been converted with str, which is
+# what hashing it with BitHash does.
+class CountingKey(object):
+    numStr = 0
+    def __init__(self, i): self.i = i
+    def __eq__(self, other): return self.i == other.i
+    def __str__(self):
+        CountingKey.numStr += 1
+        return str(self.i)
+
+# Test that each key is hashed exactly once when it is inserted, no matter
+# how many times it is evicted or the CuckooHash grows, since the CuckooHash
+# caches the base hash of each key.
+def test_hash_cached():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}):
+        c = CuckooHash(10, **options)
+        keys = [CountingKey(i) for i in range(5000)]
+        CountingKey.numStr = 0
+        for i in range(len(keys)): c.insert(keys[i], i)
+        assert CountingKey.numStr == len(keys)
+        
+        for i in range(len(keys)): assert c.find(CountingKey(i)) == i
+
+# Test a CuckooHash that resizes incrementally: while a resize is in progress
+# all the keys (in the old and the new arrays) can be found and deleted, and
+# the resize finishes after a bounded number of operations.
+def test_incremental_resize():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}):
+        c = CuckooHash(10, resizeStep = 4, **options)
+        numKeys = randint(2000, 5000)
+        for i in range(numKeys): assert c.insert(str(i), i)
+        assert len(c) == numKeys
+        assert not c.insert("0", 0)
+        
+        # Insert keys until a resize starts
+        i = numKeys
+        while not c.isResizing():
+            assert c.insert(str(i), i)
+            i += 1
+        numKeys = i
+            
+        # Every key can be found while the resize is in progress, and the 
+        # resize is finished after at most one operation for every 
+        # resizeStep keys or 4*resizeStep slots of the old arrays
+        numOps = 0
+        while c.isResizing():
+            assert c.find(str(numOps % numKeys)) == numOps % numKeys
+            numOps += 1
+        assert numOps <= numKeys / 4 + c.capacity() / 1.5 / 16 + 1
+        for i in range(numKeys): assert c.find(str(i)) == i
+        
+        assert c.findMany(str(i) for i in range(numKeys)) == list(range(numKeys))
+        assert sorted(c.getKeys(), key=int) == [str(i) for i in range(numKeys)]
+        for i in range(0, numKeys, 2): assert c.delete(str(i)) == (str(i), i)
+        assert len(c) == numKeys - (numKeys+1)//2
+        for i in range(numKeys): 
+            assert c.find(str(i)) == (i if i % 2 else None)
+
+# Test deleting and looking up keys while an incremental resize is in progress
+def test_incremental_resize_delete():
+    c = CuckooHash(100, resizeStep = 2)
+    i = 0
+    while not c.isResizing():
+        c.insert(i, i)
+        i += 1
+    numKeys = i
+    
+    # delete half the keys (some of which are still in the old arrays)
+    for i in range(0, numKeys, 2): assert c.delete(i) == (i, i)
+    assert c.containsMany(range(numKeys)) == [i % 2 == 1 for i in range(numKeys)]
+    assert len(c) == numKeys//2
+    assert sorted(c.getData()) == list(range(1, numKeys, 2))
+
+# A grow while an incremental resize is in progress (because the new arrays
+# filled up, or an entry couldn't be placed in them) rehashes the entries of
+# both the old and the new arrays into bigger arrays
+def test_incremental_grow():
+    for step in (1, 16):
+        c = CuckooHash(1000, keyType = int, resizeStep = step)
+        for i in range(20000): c.insert(i, i)
+        assert len(c) == 20000 and all(c.find(i) == i for i in range(20000))
+
+# A key whose string is always the same, so that all such keys have the same
+# hash values and compete for the same slots.
+class CollidingKey(object):
+    def __init__(self, n): self.n = n
+    def __str__(self): return "collide"
+    def __eq__(self, other): 
+        return isinstance(other, CollidingKey) and self.n == other.n
+    def __hash__(self): return self.n
+
+# Entries that can't be placed go into the stash instead of growing the table,
+# and can still be found and deleted there
+def test_stash():
+    c = CuckooHash(100, stashSize = 2)
+    keys = [CollidingKey(i) for i in range(4)]
+    for k in keys: assert c.insert(k, k.n)
+    assert c.capacity() == 200 and c.stashed() == 2 and len(c) == 4
+    for k in keys: assert c.find(k) == k.n
+    assert not c.insert(keys[3], 3)
+    
+    # deleting from the arrays moves an entry out of the stash
+    assert c.delete(keys[0]) == (keys[0], 0)
+    assert c.stashed() == 1 and len(c) == 3
+    assert c.findMany(keys) == [None, 1, 2, 3]
+    for k in keys[1:]: assert c.delete(k) == (k, k.n)
+    assert len(c) == 0 and c.stashed() == 0
+
+def test_insert_stash():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}, 
+                    {"resizeStep": 8}):
+        insert_test(1000, stashSize = 4, **options)
+        delete_all(1000, stashSize = 4, **options)
+
+def test_insert_bfs():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}, 
+                    {"stashSize": 2}, {"resizeStep": 8}):
+        insert_test(1000, insertStrategy = "bfs", **options)
+        delete_all(1000, insertStrategy = "bfs", **options)
+    with pytest.raises(ValueError): CuckooHash(10, insertStrategy = "dfs")
+
+# The breadth-first search places every key up to 95% load with buckets of 4
+def test_bfs_high_load():
+    c = CuckooHash(1000, bucketSize = 4, maxLoadFactor = 0.97, 
+                   insertStrategy = "bfs")
+    for i in range(1900): c.insert(str(i), i)
+    assert c.capacity() == 2000
+    for i in range(1900): assert c.find(str(i)) == i
+
+def test_stats():
+    resizes = []
+    c = CuckooHash(10, collectStats = True, 
+                   onResize = lambda old, new: resizes.append((old, new)))
+    for i in range(1000): c.insert(str(i), i)
+    s = c.stats()
+    assert s["numKeys"] == 1000 and s["capacity"] == c.capacity()
+    assert s["loadFactor"] == c.loadFactor()
+    assert sum(s["keysPerTable"]) + s["stashed"] == 1000
+    assert s["grows"] == len(resizes) > 0 and s["rehashes"] >= s["grows"]
+    assert resizes[-1][1] == c.capacity()
+    assert all(old < new for old, new in resizes)
+    assert s["evictions"] == sum(n * count for n, count in 
+                                 s["chainLengths"].items())
+    
+    # without collectStats, only the description of the table is given
+    assert set(CuckooHash(10).stats()) == \
+           {"numKeys", "capacity", "loadFactor", "stashed", "keysPerTable"}
+
+def test_stats_incremental():
+    resizes = []
+    c = CuckooHash(10, resizeStep = 4, collectStats = True, insertStrategy = 
+                   "bfs", onResize = lambda old, new: resizes.append(new))
+    for i in range(1000): c.insert(str(i), i)
+    assert c.stats()["grows"] == len(resizes) > 0
+    
+    # while a resize is in progress, the keys of both the old and the new 
+    # arrays (and stashes) are counted
+    c = CuckooHash(10, resizeStep = 1, stashSize = 2, numTables = 3)
+    checked = 0
+    for i in range(1000): 
+        c.insert(i, i)
+        if not c.isResizing(): continue
+        s = c.stats()
+        assert len(s["keysPerTable"]) == 3 and all(s["keysPerTable"])
+        assert sum(s["keysPerTable"]) + s["stashed"] == len(c) == i + 1
+        checked += 1
+    assert checked > 100
+
+def test_thread_safe():
+    insert_test(1000, threadSafe = True)
+    delete_all(1000, threadSafe = True, bucketSize = 4)
+    c = CuckooHash(10, threadSafe = True, collectStats = True)
+    assert c.insertMany((str(i), i) for i in range(100)) == 100
+    assert c.findMany(["5", "x"]) == [5, None]
+    assert c.containsMany(["5", "x"]) == [True, False]
+    assert c.stats()["grows"] == 0
+
+# Keys that are already in the table are always found by readers while other
+# threads insert (making entries move and the table grow) and delete keys
+def test_thread_safe_concurrent():
+    import sys, threading
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        c = CuckooHash(10, threadSafe = True)
+        for i in range(200): c.insert(i, i)
+        misses = []
+        def read():
+            for n in range(20):
+                for i in range(200): 
+                    if c.find(i) != i: misses.append(i)
+        def write(first):
+            for i in range(first, first + 2000): 
+                if not c.insert(i, i): misses.append(i)
+            for i in range(first, first + 2000, 2): 
+                if c.delete(i) != (i, i): misses.append(i)
+        threads = [threading.Thread(target = read) for i in range(2)] + \
+                  [threading.Thread(target = write, args = (10000*(n+1),))
+                   for n in range(2)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    finally: sys.setswitchinterval(interval)
+    
+    assert misses == []
+    assert len(c) == 2200 and len(c.getKeys()) == 2200
+    for i in range(200): assert c.find(i) == i
+
+def test_sharded():
+    t = ShardedCuckooHash({i: -i for i in range(5000)}, numShards = 4, 
+                          processes = 0)
+    try:
+        assert len(t) == 5000
+        for i in range(5000): assert t.find(i) == -i
+        assert t.findMany([1, 5000, -1]) == [-1, None, None]
+        
+        # another ShardedCuckooHash can attach to the same table by name
+        other = ShardedCuckooHash(name = t.name())
+        assert len(other) == 5000 and other.find(42) == -42
+        other.close()
+    finally: t.unlink()
+
+    t = ShardedCuckooHash(((bytes([i])*12, bytes([i])*3) for i in range(256)),
+                          keyType = bytes, keyWidth = 12, dataType = bytes, 
+                          dataWidth = 3, bucketSize = 1, processes = 0)
+    try:
+        assert t.find(b"\x07"*12) == b"\x07"*3 and t.find(b"ab"*6) is None
+        with pytest.raises(ValueError): t.find(b"short")
+    finally: t.unlink()
+    
+    # The last pair of a key wins, and int keys must fit in 64 bits
+    t = ShardedCuckooHash([(1, 10), (1, 20), (-1, 30)], processes = 0)
+    try:
+        assert len(t) == 2 and t.find(1) == 20 and t.find(-1) == 30
+        with pytest.raises(ValueError): t.find(2**64 + 1)
+    finally: t.unlink()
+    with pytest.raises(ValueError): 
+        ShardedCuckooHash([(1, 10), (2**64 + 1, 30)], processes = 0)
+
+def test_sharded_processes():
+    import multiprocessing, pickle
+    t = ShardedCuckooHash(((i, i*i) for i in range(20000)), numShards = 4,
+                          processes = 2)
+    try:
+        assert len(t) == 20000
+        assert len(pickle.dumps(t)) < 100
+        # The bound method pickles as the table's name and the method's name
+        with multiprocessing.Pool(2) as pool:
+            results = pool.map(t.findMany, 
+                               [range(n, 20000, 4) for n in range(4)])
+        for n in range(4): 
+            assert results[n] == [i*i for i in range(n, 20000, 4)]
+    finally: t.unlink()
+
+# A saved snapshot can be opened and looked up in, for every kind of table
+def test_save_mapped(tmp_path):
+    keys = {None: [str(i) for i in range(2000)] + [None, (1, 2)], 
+            int: list(range(-1000, 1000)), 
+            bytes: [i.to_bytes(5, "little") for i in range(2000)]}
+    for keyType in keys:
+        for options in ({}, {"bucketSize": 4}, {"resizeStep": 4}):
+            c = CuckooHash(100, keyType = keyType, keyWidth = 5, **options)
+            for n, k in enumerate(keys[keyType]): c.insert(k, [n])
+            path = str(tmp_path / "snapshot")
+            c.save(path)
+            
+            m = MappedCuckooHash(path)
+            assert len(m) == len(c) and m.capacity() == c.capacity()
+            for n, k in enumerate(keys[keyType]): assert m.find(k) == [n]
+            missing = "x" if keyType is None else 5000 if keyType is int \
+                      else b"xxxxx"
+            assert m.find(missing) is None
+            assert m.containsMany([keys[keyType][0], missing]) == [True, False]
+            assert sorted(map(str, m.getKeys())) == \
+                   sorted(map(str, c.getKeys()))
+            assert sorted(m.getData()) == sorted(c.getData())
+            m.close()
+
+def test_save_mapped_stash(tmp_path):
+    c = CuckooHash(100, stashSize = 2)
+    keys = [CollidingKey(i) for i in range(4)]
+    for k in keys: c.insert(k, k.n)
+    c.save(str(tmp_path / "snapshot"))
+    m = MappedCuckooHash(str(tmp_path / "snapshot"))
+    assert m.findMany(keys + [CollidingKey(4)]) == [0, 1, 2, 3, None]
+    m.close()
+
+# A cuckoo filter has no false negatives, about the requested rate of false
+# positives, and takes a few bytes per key
+def test_cuckoo_filter():
+    f = CuckooFilter(5000, fpRate = 0.01)
+    for i in range(5000): assert f.insert(str(i))
+    assert len(f) == 5000 and f.sizeInBytes() < 3 * 5000
+    assert all(f.containsMany(str(i) for i in range(5000)))
+    falsePositives = sum(f.containsMany("x" + str(i) for i in range(20000)))
+    assert falsePositives < 20000 * 0.02
+    
+    for i in range(0, 5000, 2): assert f.delete(str(i))
+    assert len(f) == 2500
+    assert all(f.contains(str(i)) for i in range(1, 5000, 2))
+    assert sum(f.containsMany(str(i) for i in range(0, 5000, 2))) < 2500*0.02
+
+# Once full, a filter refuses new keys but still knows every key it took
+def test_cuckoo_filter_full():
+    f = CuckooFilter(100, keyType = int)
+    n = 0
+    while f.insert(n): n += 1
+    assert n >= f.capacity() * 0.85
+    assert all(f.contains(i) for i in range(n))
+    for i in range(n // 5): assert f.delete(i)
+    assert f.insert(n)
+    assert all(f.contains(i) for i in range(n // 5, n+1))
+
+# With a miss summary, every key is still found, through deletes, the stash,
+# growing and incremental resizes, while most missing keys are rejected
+def test_miss_summary():
+    for options in ({}, {"bucketSize": 4}, {"numTables": 3}, 
+                    {"resizeStep": 4}, {"stashSize": 4}, {"keyType": int},
+                    {"insertStrategy": "bfs"}, {"threadSafe": True}):
+        c = CuckooHash(10, missSummary = True, **options)
+        expected = {}
+        for i in range(3000):
+            k = randrange(1000)
+            if random() < 0.3: 
+                assert c.delete(k) == ((k, expected.pop(k)) if k in expected
+                                       else None)
+            else: 
+                assert c.insert(k, i) == (k not in expected)
+                expected.setdefault(k, i)
+        assert len(c) == len(expected)
+        assert all(c.find(k) == expected.get(k) for k in range(1100))
+        
+    insert_test(1000, missSummary = True)
+    delete_all(1000, missSummary = True)
+    c = CuckooHash(100, stashSize = 2, missSummary = True)
+    keys = [CollidingKey(i) for i in range(4)]
+    for k in keys: assert c.insert(k, k.n)
+    assert c.stashed() == 2 and c.findMany(keys) == [0, 1, 2, 3]
+    assert c.delete(keys[0]) == (keys[0], 0)
+    assert c.findMany(keys) == [None, 1, 2, 3]
+
+# An AsyncCuckooHash keeps answering lookups while a background task moves
+# its entries to new arrays, a chunk at a time
+def test_async():
+    async def run():
+        c = AsyncCuckooHash(10, chunkSize = 100)
+        assert await c.insertMany((str(i), i) for i in range(2000)) == 2000
+        assert await c.insert("0", 0) is False
+        await c.resized()
+        assert not c.isResizing() and len(c) == 2000
+        assert c.findMany(["5", "x"]) == [5, None]
+        
+        # rebuilding yields to the event loop until every entry has moved
+        capacity = c.table().capacity()
+        rebuild = asyncio.create_task(c.rebuild(4000))
+        await asyncio.sleep(0)
+        chunks = 0
+        while not rebuild.done():
+            assert all(c.find(str(i)) == i for i in range(0, 2000, 401))
+            chunks += c.isResizing()
+            await asyncio.sleep(0)
+        assert chunks > 2 and c.table().capacity() > capacity
+        assert all(c.find(str(i)) == i for i in range(2000))
+        assert await c.delete("7") == ("7", 7) and len(c) == 1999
+        
+        # rebuilding while a resize is in progress waits for it to finish 
+        # in the background, instead of finishing it all at once
+        c.table().rehash(8000)
+        assert c.isResizing()
+        rebuild = asyncio.create_task(c.rebuild())
+        await asyncio.sleep(0)
+        assert not rebuild.done() and c.isResizing()
+        await rebuild
+        assert not c.isResizing() and len(c) == 1999
+    asyncio.run(run())
+
+# A delete that starts shrinking an AsyncCuckooHash moves the entries in the
+# background too, while lookups are still answered
+def test_async_shrink():
+    async def run():
+        c = AsyncCuckooHash(10, chunkSize = 100, minLoadFactor = 0.1)
+        await c.insertMany((i, i) for i in range(2000))
+        await c.resized()
+        capacity = c.table().capacity()
+        i = 0
+        while not c.isResizing(): 
+            assert await c.delete(i) == (i, i)
+            i += 1
+        assert c.table().capacity() < capacity
+        assert all(c.find(j) == j for j in range(i, 2000, 97))
+        await c.resized()
+        assert not c.isResizing() and len(c) == 2000 - i
+        assert c.findMany([0, i, 1999]) == [None, i, 1999]
+    asyncio.run(run())
+
+# An entry that can't be placed in the new arrays during an incremental 
+# resize makes both the old and the new arrays rehash into bigger ones
+def test_incremental_failed_placement():
+    c = CuckooHash(1000, keyType = int, resizeStep = 16, collectStats = True)
+    for i in range(20000): c.insert(i, i)
+    assert c.stats()["failedPlacements"] > 0 and len(c) == 20000
+    assert all(c.find(i) == i for i in range(20000))
+    
+    # findMany and containsMany move entries before looking keys up, which
+    # may make the arrays grow, and must then look in the new arrays
+    for trial in range(100):
+        c = CuckooHash(4, keyType = int, resizeStep = 64)
+        for i in range(300):
+            c.insert(i, i)
+            if c.isResizing(): 
+                assert c.findMany(range(i+2)) == list(range(i+1)) + [None]
+                assert c.containsMany([0, i, -1]) == [True, True, False]
+
+# rehash moves every entry to new arrays, all at once or incrementally
+def test_rehash():
+    for options in ({}, {"resizeStep": 4}, {"threadSafe": True}, 
+                    {"stashSize": 2, "missSummary": True}):
+        c = makeCuckooHash(1000, 300, **options)
+        c.rehash(2000)
+        while c.continueResize(): pass
+        assert c.capacity() == 4000 and len(c) == 300
+        assert all(c.find(str(i)) == i for i in range(300))
+        c.rehash()
+        while c.continueResize(): pass
+        assert c.capacity() == 4000 and len(c) == 300
+        assert all(c.find(str(i)) == i for i in range(300))
+
+# A CuckooHash can be used like a dict, with the same results
+def test_mutable_mapping():
+    for options in ({}, {"bucketSize": 4}, {"resizeStep": 4}, 
+                    {"threadSafe": True}, {"missSummary": True}):
+        c = CuckooHash(10, **options)
+        d = {}
+        for i in range(2000):
+            k = randrange(500)
+            if random() < 0.3:
+                assert (k in c) == (k in d)
+                if k not in d:
+                    with pytest.raises(KeyError): del c[k]
+                else:
+                    del c[k]
+                    del d[k]
+            else: c[k] = d[k] = i
+        assert len(c) == len(d) and c == d
+        assert sorted(c) == sorted(d) and sorted(c.keys()) == sorted(d)
+        assert sorted(c.values()) == sorted(d.values())
+        assert sorted(c.items()) == sorted(d.items())
+        assert all(c[k] == d[k] for k in c) and not c.isResizing()
+        
+        k = next(iter(d))
+        assert c.pop(k) == d.pop(k) and c.pop(k, "x") == "x"
+        with pytest.raises(KeyError): c[k]
+        with pytest.raises(KeyError): c.pop(k)
+        assert c.get(k) is None and c.get(k, 1) == 1
+        c.update({-1: None}, x = 2)
+        assert c[-1] is None and -1 in c and c["x"] == 2
+        capacity = c.capacity()
+        c.clear()
+        assert len(c) == 0 and c.getKeys() == [] and -1 not in c
+        assert c.capacity() == capacity
+
+# A table made with minLoadFactor shrinks as keys are deleted, and reserve 
+# and compact resize it to fit a given number of keys
+def test_shrink():
+    for options in ({}, {"bucketSize": 4}, {"resizeStep": 4}, 
+                    {"threadSafe": True}, {"stashSize": 2}):
+        resizes = []
+        c = makeCuckooHash(10, 5000, minLoadFactor = 0.1, onResize = 
+                           lambda old, new: resizes.append(new), **options)
+        big = c.capacity()
+        for i in range(4900): assert c.delete(str(i)) == (str(i), i)
+        while c.continueResize(): pass
+        assert c.capacity() < big / 4 and resizes[-1] == c.capacity()
+        assert c.loadFactor() >= 0.1 and len(c) == 100
+        assert all(c[str(i)] == i for i in range(4900, 5000))
+        
+        # growing back up works as usual
+        for i in range(5000): c.insert(str(i), i)
+        assert all(c[str(i)] == i for i in range(5000))
+
+def test_reserve_compact():
+    c = CuckooHash(10, bucketSize = 4, collectStats = True)
+    c.reserve(10000)
+    capacity = c.capacity()
+    assert capacity >= 10000
+    for i in range(10000): c.insert(i, i)
+    assert c.capacity() == capacity and c.stats()["grows"] == 0
+    c.reserve(100)
+    assert c.capacity() == capacity
+    
+    for i in range(9000): del c[i]
+    c.compact()
+    assert c.capacity() < capacity / 5 and len(c) == 1000
+    assert all(c[i] == i for i in range(9000, 10000))
+    assert c.loadFactor() < defaultMaxLoadFactor(4)
+
+# Every hash backend finds every kind of key it can hash, snapshots of its
+# tables are hashed the same way, and any family class can be plugged in
+def test_hash_backends(tmp_path):
+    keys = [str(i) for i in range(500)] + list(range(-500, 500)) + \
+           [i.to_bytes(3, "little") for i in range(500)] + [None, (1, 2)]
+    for backend in HASH_BACKENDS:
+        if backend == "xxhash" and xxhash is None:
+            with pytest.raises(ImportError): 
+                CuckooHash(10, hashBackend = backend)
+            continue
+        backendKeys = keys if backend != "multiplyShift" else \
+                      list(range(-500, 500))
+        c = CuckooHash(10, bucketSize = 2, hashBackend = backend)
+        for n, k in enumerate(backendKeys): assert c.insert(k, n)
+        assert len(c) == len(backendKeys)
+        assert all(c[k] == n for n, k in enumerate(backendKeys))
+        assert 10**6 not in c and c.find(backendKeys[0]) == 0
+        
+        path = str(tmp_path / "snapshot")
+        c.save(path)
+        m = MappedCuckooHash(path)
+        assert all(m.find(k) == n for n, k in enumerate(backendKeys))
+        m.close()
+    
+    with pytest.raises(ValueError): CuckooHash(10, hashBackend = "md5")
+    class PythonHashFamily(BitHashFamily):
+        def baseHash(self, s): return hash(s) & (2**64 - 1)
+    c = CuckooHash(10, bucketSize = 4, hashBackend = PythonHashFamily)
+    for k in keys: c[k] = k
+    assert all(c[k] == k for k in keys)
+    with pytest.raises(ValueError): c.save(str(tmp_path / "snapshot"))
+
+# A frozen table has the same entries as the table it was made from, packed
+# into fewer slots, and the table can still be changed afterwards
+def test_freeze():
+    for options in ({}, {"keyType": int}, {"resizeStep": 4}, 
+                    {"stashSize": 2}, {"threadSafe": True}, {"numTables": 3}):
+        c = CuckooHash(10, **options)
+        for i in range(3000): c[i] = str(i)
+        f = c.freeze()
+        assert len(f) == 3000 and f.capacity() < c.capacity()
+        assert f.loadFactor() > 0.8
+        assert all(f[i] == str(i) for i in range(3000))
+        assert f.find(-1) is None and f.get(-1, 0) == 0 and -1 not in f
+        with pytest.raises(KeyError): f[-1]
+        assert f.findMany([5, -1]) == ["5", None] 
+        assert f.containsMany([5, -1]) == [True, False]
+        assert sorted(f) == list(range(3000)) and dict(f) == dict(c)
+        
+        del c[0]
+        assert 0 not in c and f[0] == "0"
+    assert len(CuckooHash(10).freeze()) == 0
+    
+    # The frozen table keeps packed copies of the keys and data (bytes keys
+    # of a fixed width as they are), rather than references to them
+    c = CuckooHash(10, keyType = bytes, keyWidth = 3)
+    for i in range(1000): c[i.to_bytes(3, "little")] = [i]
+    f = c.freeze()
+    keys = [i.to_bytes(3, "little") for i in range(1000)]
+    assert all(f[k] == [i] for i, k in enumerate(keys))
+    assert sorted(f) == sorted(keys) and b"zzz" not in f
+    assert f[keys[1]] == c[keys[1]] and f[keys[1]] is not c[keys[1]]
+
+def test_cache():
+    for options in ({}, {"bucketSize": 4}, {"stashSize": 2}, 
+                    {"missSummary": True}, {"insertStrategy": "bfs"}):
+        c = CuckooHash(100, cache = True, **options)
+        cap = c.capacity()
+        lost = inserted = 0
+        for i in range(2000):
+            # Keep finding the first 10 keys, which should hardly ever be
+            # evicted (only by an insert that runs into an eviction loop)
+            for h in range(min(i, 10)): 
+                if c.find(h) is None: 
+                    lost += 1
+                    inserted += c.insert(h, h)
+            
+            # An insert never evicts its own key
+            assert c.find(i) is None and c.insert(i, i)
+            inserted += 1
+            assert i in c.getKeys() and c.capacity() == cap
+        
+        s = c.stats()
+        assert lost < 20 and s["misses"] == 2000 + lost
+        assert s["hits"] + s["misses"] == 45 + 10 * 1990 + 2000
+        assert s["cacheEvictions"] == inserted - len(c) 
+        assert len(c) > cap / 3
+        
+        # Every key still in the cache has its own data, and every key
+        # evicted from it is gone
+        present = dict(c.items())
+        assert all(k == d for k, d in present.items())
+        assert sum(k in c for k in range(2000)) == len(c) == len(present)
+        c.delete(9)
+        assert c.find(9) is None and 9 not in c
+    with pytest.raises(AssertionError): CuckooHash(10, cache = True, 
+                                                   resizeStep = 4)
+
+def test_export_import(tmp_path):
+    for options in ({}, {"bucketSize": 4, "stashSize": 2}, 
+                    {"keyType": int, "resizeStep": 4}, {"threadSafe": True},
+                    {"hashBackend": "blake2b", "numTables": 3}):
+        c = CuckooHash(10, **options)
+        for i in range(3000): c[i] = str(i)
+        chunks = list(c.exportChunks(500))
+        numSlots = c.capacity() + options.get("stashSize", 0)
+        assert len(chunks) == 1 + -(-numSlots // 500)
+        
+        # The imported table has the same slots, so it iterates in the same
+        # order, and it hashes like the exported one
+        d = CuckooHash.importChunks(iter(chunks), missSummary = True)
+        assert list(d.items()) == list(c.items()) and len(d) == 3000
+        assert d.capacity() == c.capacity() and d.stashed() == c.stashed()
+        assert all(d[i] == str(i) for i in range(3000)) and -1 not in d
+        d[-1] = "-1"
+        del d[0]
+        assert d[-1] == "-1" and 0 not in d and len(d) == 3000
+        
+        with pytest.raises(ValueError): 
+            CuckooHash.importChunks(chunks[:-2])
+    
+    # An imported table keeps the key width of the exported one, so it can
+    # be saved and looked up in
+    c = CuckooHash(10, keyType = bytes, keyWidth = 5)
+    for i in range(500): c.insert(i.to_bytes(5, "little"), i)
+    d = CuckooHash.importChunks(c.exportChunks())
+    assert d.findMany([(7).to_bytes(5, "little")]) == [7]
+    d.save(tmp_path / "imported")
+    m = MappedCuckooHash(tmp_path / "imported")
+    assert m.find((7).to_bytes(5, "little")) == 7
+    m.close()
+
+def test_change_log():
+    for options in ({}, {"threadSafe": True}, {"resizeStep": 4}):
+        c = CuckooHash(10, changeLog = True, **options)
+        for i in range(100): c.insert(i, i)
+        assert c.logPosition() == 100 and not c.insert(5, 5)
+        
+        # A follower imports the table, then catches up with every change
+        # made since, a few at a time
+        f = CuckooHash.importChunks(c.exportChunks())
+        assert f.logPosition() == 100
+        for i in range(100, 1000): c[i] = i
+        for i in range(0, 1000, 3): del c[i]
+        for i in range(1, 1000, 3): c[i] = -i
+        c.delete(-5)
+        while True:
+            changes = c.changesSince(f.logPosition(), 100)
+            if not changes: break
+            f.applyChanges(changes)
+        assert f.logPosition() == c.logPosition() and dict(f) == dict(c)
+        
+        # A follower that keeps its own log can be followed in turn
+        g = CuckooHash.importChunks(f.exportChunks(), changeLog = True)
+        c.clear()
+        c[1] = 1
+        f.applyChanges(c.changesSince(f.logPosition()))
+        g.applyChanges(c.changesSince(g.logPosition()))
+        assert dict(f) == dict(g) == {1: 1} 
+        assert g.changesSince(g.logPosition() - 2) == [("clear",), 
+                                                       ("insert", 1, 1)]
+        
+        # Changes that have been trimmed can't be replayed anymore
+        c.trimLog(c.logPosition() - 1)
+        assert c.changesSince(c.logPosition() - 1) == [("insert", 1, 1)]
+        with pytest.raises(ValueError): c.changesSince(0)
+    with pytest.raises(AssertionError): CuckooHash(10, cache = True,
+                                                   changeLog = True)
+
+# Keys of different types with the same str or bytes, like 1, "1" and b"1", 
+# have different base hashes, so they don't collide for good, with any hash
+# backend that takes them
+def test_mixed_key_types():
+    keys = [1, "1", b"1", 1.5, "1.5", b"1.5", None, "None", (1,), "(1,)"]
+    for backend in HASH_BACKENDS:
+        if backend == "multiplyShift" or \
+           backend == "xxhash" and xxhash is None: continue
+        c = CuckooHash(4, hashBackend = backend)
+        for n, k in enumerate(keys): assert c.insert(k, n)
+        assert len(c) == len(keys) and c.capacity() < 100
+        assert all(c[k] == n for n, k in enumerate(keys))
+        
+# When too many keys have the same base hash to ever fit, inserting and 
+# freezing give up with RuntimeError after a few attempts, instead of growing
+# the arrays until memory runs out. (With an incremental resize, that is only
+# once the resize gets to the colliding keys.) Except for the entry that 
+# couldn't be placed, the entries stay in the table.
+def test_colliding_keys_give_up():
+    for stash, options in ((1, {}), (1, {"resizeStep": 1}), 
+                           (0, {"threadSafe": True})):
+        c = CuckooHash(100, stashSize = stash, **options)
+        keys = [CollidingKey(i) for i in range(2 + stash)]
+        for k in keys: c.insert(k, k.n)
+        with pytest.raises(RuntimeError): 
+            c.insert(CollidingKey(-1), -1)
+            c.continueResize(100)
+        assert len(c) == len(keys) and c.capacity() < 10000
+        keys.append(CollidingKey(-1))
+        assert sum(c.find(k) is not None for k in keys) == len(keys) - 1
+        c.insert(0, 0)
+        assert c.find(0) == 0 and len(c) == len(keys)
+    
+    # Three such keys fit in a table with a stash, but not in a frozen one
+    c = CuckooHash(100, stashSize = 1)
+    for i in range(3): c.insert(CollidingKey(i), i)
+    with pytest.raises(RuntimeError): c.freeze(bucketSize = 1)
    
 pytest.main(["-v", "-s", "test_CuckooHash_SG.py"])
 